@@ -1,8 +1,7 @@
 import os
-import io
-
-from PIL import Image
+import sys
 
+import torch
 import torchvision.transforms as T
 
 from braceexpand import braceexpand
@@ -10,6 +9,11 @@ import webdataset as wds
 
 from utils import load_json, get_config
 
+# shard_reader.py is in the dataset directory
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dataset"))
+
+from shard_reader import IMAGE_KEYS, BlobIndexDataset, load_image
+
 config = get_config()
 
 class EvalWebDataset:
@@ -25,8 +29,14 @@ class EvalWebDataset:
         self.transform = transform if transform else T.Compose([lambda x: x])
         self.split = split + "_150" if split == "train" else split
         data_dir = f"{self.root}/deeppatent2/cls/{aspect}/{self.split}/"
-        shard_count = f"{(len(os.listdir(data_dir))-1):06d}"
-        self.shards = braceexpand(data_dir+"shard-{000000.."+shard_count+"}.tar")
+        self.index_path = os.path.join(data_dir, "index.json")
+
+        if os.path.isfile(self.index_path): # blob layout
+            self.shards = []
+        else:
+            shard_files = [f for f in os.listdir(data_dir) if f.startswith("shard-") and f.endswith(".tar")]
+            shard_count = f"{(len(shard_files)-1):06d}"
+            self.shards = list(braceexpand(data_dir+"shard-{000000.."+shard_count+"}.tar"))
 
         self.concept2idx = {concept: idx for idx, concept in enumerate(self.get_concepts())}
         
@@ -34,11 +44,18 @@ class EvalWebDataset:
         return load_json(f"{config['cls_dataset_path']}/{self.aspect}/concepts.json")["concepts"]
 
     def get_wds(self):
+        if not self.shards:
+            return BlobIndexDataset(self.index_path,
+                                    lambda image: self.transform(load_image(image, as_tensor=True)),
+                                    lambda label: self.concept2idx[label],
+                                    shuffle=self.split.startswith("train"),
+                                    seed=config["seed"])
+
         return (wds.WebDataset(self.shards)
                     .shuffle(5000 if self.split.startswith("train") else 0)
-                    .to_tuple("__key__", "image.png", "label.txt")
+                    .to_tuple("__key__", IMAGE_KEYS, "label.txt")
                     .map_tuple(
                         lambda key: key,
-                        lambda image: self.transform(Image.open(io.BytesIO(image))),
+                        lambda image: self.transform(load_image(image, as_tensor=True)),
                         lambda label: self.concept2idx[label.decode("utf-8")]
                     ))
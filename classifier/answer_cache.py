@@ -0,0 +1,81 @@
+import os
+import sqlite3
+
+def normalize_answer(answer):
+    """Normalise an LVLM answer text for lookup (strip and collapse whitespace)"""
+    return " ".join(answer.split())
+
+class AnswerCache:
+    """
+        Persistent memo of open-ended answer to concept mappings
+
+        The mappings are stored in a SQLite database keyed by aspect, concept
+        set, normalised answer text and embedding model id, so they can be
+        reused across runs and LVLM checkpoints
+    """
+    def __init__(self, path, model_id):
+        """
+            Args:
+                path: SQLite database file
+                model_id: id of the embedding model used for the mapping
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.model_id = model_id
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                aspect TEXT,
+                concepts TEXT,
+                answer TEXT,
+                model_id TEXT,
+                concept TEXT,
+                PRIMARY KEY (aspect, concepts, answer, model_id)
+            )
+        """)
+        self.connection.commit()
+
+    def get_many(self, aspect, concepts, answers):
+        """
+            Look up normalised answers
+
+            Args:
+                aspect: aspect the answers are classified to
+                concepts: fingerprint of the concept set of the aspect
+                answers: normalised answer texts
+
+            Returns:
+                Dictionary of answer to concept for the answers found
+        """
+        found = {}
+        answers = list(set(answers))
+
+        for i in range(0, len(answers), 500):
+            chunk = answers[i:i+500]
+            rows = self.connection.execute(
+                "SELECT answer, concept FROM answers WHERE aspect = ? AND concepts = ? AND model_id = ? "
+                f"AND answer IN ({','.join('?' * len(chunk))})",
+                [aspect, concepts, self.model_id, *chunk]
+            )
+            found.update(rows.fetchall())
+
+        return found
+
+    def put_many(self, aspect, concepts, mapping):
+        """
+            Store answer to concept mappings
+
+            Args:
+                aspect: aspect the answers are classified to
+                concepts: fingerprint of the concept set of the aspect
+                mapping: dictionary of normalised answer text to concept
+        """
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?)",
+            [(aspect, concepts, answer, self.model_id, concept) for answer, concept in mapping.items()]
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
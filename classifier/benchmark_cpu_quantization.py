@@ -0,0 +1,86 @@
+import gc
+import time
+import itertools
+
+from argparse import ArgumentParser
+
+import torch
+
+from common_utils import get_config
+from metadata import get_template
+
+def run(model, batches, template, aspect):
+    """Classify the batches with the open-ended classifier, return answers and figures/s"""
+    from open_classifier import classify, compute_accuracy
+
+    start = time.perf_counter()
+    answers = classify(model, batches, template, aspect)
+    elapsed = time.perf_counter() - start
+
+    compute_accuracy(answers)
+
+    return answers, len(answers) / elapsed
+
+def main(aspect, model_dir, num_figures, num_threads):
+
+    from dataset import get_dataloader
+    from model_utils import get_model_and_preprocess, optimize_for_cpu, get_model_size
+
+    config = get_config()
+
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    # LAVIS loads the FlanT5 weights in bfloat16, the reference is cast to fp32
+    model, vis_preprocess = get_model_and_preprocess(model_dir)
+    model = model.float()
+    template = get_template("oc", aspect)
+
+    loader = get_dataloader(aspect, vis_preprocess)
+    batches = list(itertools.islice(loader, -(-num_figures // config["batch_size"])))
+
+    print(f"fp32 ({torch.get_num_threads()} threads)")
+    fp32_size = get_model_size(model)
+    fp32_answers, fp32_speed = run(model, batches, template, aspect)
+
+    # optimize_for_cpu changes the model in place, the int8 run uses a freshly loaded model
+    del model
+    gc.collect()
+
+    model, _ = get_model_and_preprocess(model_dir)
+    model = optimize_for_cpu(model, quantize=True, bf16_vision=config["cpu_bf16_vision"])
+
+    print(f"int8 T5{', bf16 vision encoder' if model.vision_bf16 else ''}")
+    int8_size = get_model_size(model)
+    int8_answers, int8_speed = run(model, batches, template, aspect)
+
+    def accuracy(answers):
+        return 100 * sum(a["selected_answer"] == a["reference_answer"] for a in answers.values()) / len(answers)
+
+    agreement = 100 * sum(
+        int8_answers[id]["selected_answer"] == answer["selected_answer"] for id, answer in fp32_answers.items()
+    ) / len(fp32_answers)
+
+    print()
+    print(f"{len(fp32_answers)} figures of {aspect}")
+    print(f"fp32: {fp32_speed:.2f} figures/s, {accuracy(fp32_answers):.2f}%, {fp32_size / 1024**3:.2f} GB")
+    print(f"int8: {int8_speed:.2f} figures/s, {accuracy(int8_answers):.2f}%, {int8_size / 1024**3:.2f} GB")
+    print(f"speed-up: {int8_speed / fp32_speed:.2f}x, size ratio: {int8_size / fp32_size:.2f}")
+    print(f"accuracy delta: {accuracy(int8_answers) - accuracy(fp32_answers):+.2f}, "
+          f"same label for {agreement:.2f}% of the figures")
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+
+    parser.add_argument("--aspect", default="type", choices=["type", "projection", "object", "uspc"])
+    parser.add_argument("--model_dir", default=None, help="fine-tuned model output directory")
+    parser.add_argument("--num_figures", type=int, default=256)
+    parser.add_argument("--num_threads", type=int, default=None)
+
+    args = parser.parse_args()
+
+    if torch.cuda.is_available():
+        print("Run with CUDA_VISIBLE_DEVICES= to benchmark the CPU path")
+
+    main(args.aspect, args.model_dir, args.num_figures, args.num_threads)
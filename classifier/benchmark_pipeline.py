@@ -0,0 +1,278 @@
+import os
+import io
+import sys
+import json
+import time
+import zlib
+import shutil
+import resource
+import tempfile
+import subprocess
+
+from argparse import ArgumentParser, SUPPRESS
+
+import yaml
+import numpy as np
+
+CLASSIFIER_DIR = os.path.dirname(os.path.abspath(__file__))
+ASPECT = "object"
+
+# The benchmark runs in a temporary workspace with synthetic shards and a copy of
+# config.yaml, the classifier modules are imported after changing into it
+
+def create_workspace(workspace, num_figures, num_concepts, image_size, batch_size, seed):
+    """
+        Create synthetic PatFigCLS shards, concepts and config in the workspace
+
+        Args:
+            workspace: directory to create the files in
+            num_figures: number of test figures
+            num_concepts: number of classification labels
+            image_size: width and height of the figures
+            batch_size: loader batch size
+            seed: seed of the figures and labels
+    """
+    import webdataset as wds
+
+    from PIL import Image, ImageDraw
+
+    rng = np.random.default_rng(seed)
+    concepts = [f"synthetic object {k}" for k in range(num_concepts)]
+
+    with open(os.path.join(CLASSIFIER_DIR, "config.yaml")) as f:
+        config = yaml.safe_load(f)
+
+    config.update({
+        "seed": seed,
+        "num_workers": 0,
+        "batch_size": batch_size,
+        "tensor_cache_dir": None,
+        "answer_cache_path": None,
+        "cls_dataset_path": "dataset/classification",
+    })
+
+    with open(os.path.join(workspace, "config.yaml"), "w") as f:
+        yaml.safe_dump(config, f)
+
+    # concepts are read from dataset/classification (metadata, open_classifier)
+    # and the shards from classification (dataset)
+    concepts_dir = os.path.join(workspace, "dataset", "classification", ASPECT)
+    shards_dir = os.path.join(workspace, "classification", ASPECT, "test")
+    os.makedirs(concepts_dir)
+    os.makedirs(shards_dir)
+
+    with open(os.path.join(concepts_dir, "concepts.json"), "w") as f:
+        json.dump({"concepts": concepts}, f)
+
+    manifest = {"keys": [], "labels": [], "shards": [{"shard": "shard-000000.tar", "offset": 0, "count": num_figures}]}
+
+    with wds.TarWriter(os.path.join(shards_dir, "shard-000000.tar")) as sink:
+        for i in range(num_figures):
+            image = Image.new("L", (image_size, image_size), 255)
+            draw = ImageDraw.Draw(image)
+            for _ in range(20):
+                draw.line([tuple(point) for point in rng.integers(0, image_size, size=(2, 2)).tolist()], fill=0, width=2)
+
+            buffer = io.BytesIO()
+            image.save(buffer, format="PNG")
+
+            key = f"{i:08d}"
+            label = concepts[int(rng.integers(num_concepts))]
+            sink.write({"__key__": key, "image.png": buffer.getvalue(), "label.txt": label})
+
+            manifest["keys"].append(key)
+            manifest["labels"].append(label)
+
+    with open(os.path.join(shards_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+
+def create_stub_model(classifier, concepts, t, seed):
+    """
+        Return a tiny random-weight stand-in for the LVLM
+
+        The stub has the predict_answers interface used by model_utils.generate
+        and a small convolutional visual_encoder whose output stands in for the
+        cached image embeddings (mc-ts, cache_image_features). Its answers depend on the figure and the question, in the format the
+        classifier expects ('yes'/'no', an option number or a concept)
+    """
+    import torch
+
+    class StubLVLM(torch.nn.Module):
+
+        def __init__(self):
+            super().__init__()
+            torch.manual_seed(seed)
+            self.visual_encoder = torch.nn.Conv2d(3, 64, kernel_size=16, stride=16)
+            self.head = torch.nn.Linear(64, 16)
+            self.eval()
+
+        def encode(self, figures):
+            return self.visual_encoder(figures).flatten(2).transpose(1, 2)
+
+        def answer(self, image_embeds, prompts):
+            with torch.no_grad():
+                probabilities = self.head(image_embeds.mean(dim=1)).softmax(dim=-1)
+
+            answers, scores = [], []
+            for prompt, p in zip(prompts, probabilities.tolist()):
+                k = (int(np.argmax(p)) + zlib.crc32(prompt.encode("utf-8"))) % 16
+                if classifier in ["bc", "hbc"]:
+                    answers.append("yes" if k == 0 else "no")
+                elif classifier == "mc-ts":
+                    answers.append(f"({k % t + 1})")
+                else:
+                    answers.append(concepts[k % len(concepts)])
+                scores.append(max(p))
+
+            return answers, scores
+
+        def predict_answers(self, samples, **kwargs):
+            with torch.no_grad():
+                image_embeds = self.encode(samples["image"])
+            return self.answer(image_embeds, samples["text_input"])
+
+    return StubLVLM()
+
+class StubEmbeddingModel:
+    """Stand-in for PatentBERT: normalised hashed character trigram counts"""
+    def encode(self, texts, **kwargs):
+        features = np.zeros((len(texts), 256), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for j in range(len(text) - 2):
+                features[i, zlib.crc32(text[j:j+3].encode("utf-8")) % 256] += 1.0
+        return features / np.maximum(np.linalg.norm(features, axis=1, keepdims=True), 1e-12)
+
+def run_classifier(classifier, t, seed):
+    """
+        Run one classifier in the current workspace and return its measurements
+    """
+    import torch
+    import torchvision.transforms as T
+
+    import model_utils
+    import open_classifier
+    import binary_classifier
+    import mc_tournament_classifier
+
+    from dataset import get_dataloader, get_ids
+    from metadata import get_options, get_template, get_concepts
+
+    import profiling
+
+    concepts = list(get_concepts(ASPECT))
+    model = create_stub_model(classifier, concepts, t, seed)
+
+    # cached image embeddings (mc-ts, cache_image_features) are answered by the stub
+    def generate_from_embeddings(model, image_embeds, questions):
+        return model.answer(image_embeds, [f"Question: {q} Answer: " for q in questions])
+
+    model_utils.generate_from_embeddings = generate_from_embeddings
+    model_utils.device = "cpu"
+
+    @profiling.profiled("encode_images")
+    def encode_images(model, figures):
+        with torch.no_grad():
+            return model.encode(figures.float())
+
+    binary_classifier.encode_images = encode_images
+    mc_tournament_classifier.encode_images = encode_images
+
+    open_classifier._embedding_model = StubEmbeddingModel()
+
+    transform = T.Compose([T.Resize((224, 224)), T.ToTensor()])
+
+    def vis_preprocess(image):
+        return transform(image.convert("RGB"))
+
+    # the binary classifier has no postprocess step besides recording the answers
+    binary_classifier.record_answers = profiling.profiled("record_answers")(binary_classifier.record_answers)
+
+    profiler = profiling.enable()
+
+    start = time.perf_counter()
+
+    loader = get_dataloader(ASPECT, vis_preprocess)
+    template = get_template(classifier, ASPECT)
+
+    if classifier == "bc":
+        answers = binary_classifier.classify(model, loader, template, get_options(ASPECT, get_ids(ASPECT, loader)))
+    elif classifier == "mc-ts":
+        answers = mc_tournament_classifier.classify(model, loader, template,
+                                                    get_options(ASPECT, get_ids(ASPECT, loader)), t)
+    else:
+        answers = open_classifier.classify(model, loader, template, ASPECT)
+
+    total = time.perf_counter() - start
+    num_figures = len(answers)
+
+    times = profiler.times
+    seconds = {
+        "decode": times["decode"],
+        "preprocess": times["preprocess"],
+        "model": times["generate"] + times["encode_images"],
+        "postprocess": times["postprocess"] + times["find_closest_concepts"] + times["record_answers"]
+    }
+    seconds["other"] = total - sum(seconds.values())
+
+    return {
+        "figures": num_figures,
+        "seconds": total,
+        "figures_per_second": num_figures / total,
+        "lvlm_calls_per_figure": profiler.counts["generate"] / num_figures,
+        "stage_seconds": seconds,
+        "profile": profiler.summary(),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+
+def main(classifiers, num_figures, num_concepts, image_size, batch_size, t, seed, output):
+
+    workspace = tempfile.mkdtemp(prefix="benchmark_pipeline_")
+
+    try:
+        create_workspace(workspace, num_figures, num_concepts, image_size, batch_size, seed)
+
+        results = {
+            "settings": {
+                "figures": num_figures, "concepts": num_concepts, "image_size": image_size,
+                "batch_size": batch_size, "t": t, "seed": seed
+            },
+            "classifiers": {}
+        }
+
+        # each classifier runs in its own process for a separate peak RSS
+        for classifier in classifiers:
+            command = [sys.executable, os.path.abspath(__file__), "--run", classifier,
+                       "--t", str(t), "--seed", str(seed)]
+            process = subprocess.run(command, cwd=workspace, check=True, capture_output=True, text=True)
+            results["classifiers"][classifier] = json.loads(process.stdout.strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    report = json.dumps(results, indent=4)
+    print(report)
+
+    if output:
+        with open(output, "w") as f: f.write(report)
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+
+    parser.add_argument("--classifiers", nargs="+", default=["bc", "oc", "mc-ts"], choices=["bc", "oc", "mc-ts"])
+    parser.add_argument("--num_figures", type=int, default=256)
+    parser.add_argument("--num_concepts", type=int, default=50)
+    parser.add_argument("--image_size", type=int, default=256)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--t", type=int, default=5, help="options per multiple-choice question (mc-ts)")
+    parser.add_argument("--seed", type=int, default=1337)
+    parser.add_argument("--output", default=None, help="JSON file to write the results to")
+    parser.add_argument("--run", default=None, help=SUPPRESS) # classifier to run in the workspace
+
+    args = parser.parse_args()
+
+    if args.run:
+        sys.path.insert(0, CLASSIFIER_DIR)
+        print(json.dumps(run_classifier(args.run, args.t, args.seed)))
+    else:
+        main(args.classifiers, args.num_figures, args.num_concepts, args.image_size, args.batch_size,
+             args.t, args.seed, args.output)
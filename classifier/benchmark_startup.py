@@ -0,0 +1,63 @@
+import sys
+import json
+import time
+import statistics
+import subprocess
+
+from argparse import ArgumentParser
+
+# modules that must not be imported to run evaluate.py --help / --dry_run
+HEAVY_MODULES = ["torch", "lavis", "sentence_transformers", "webdataset", "transformers"]
+
+def time_command(command, repeats):
+    """Return the wall-clock times of running a command"""
+    times = []
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+
+    return times
+
+def get_imported_heavy_modules():
+    """Return the heavy modules imported by importing evaluate.py"""
+    code = (
+        "import sys, json, evaluate; "
+        f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    )
+    output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+def main(repeats, max_seconds):
+
+    results = {
+        "help": time_command([sys.executable, "evaluate.py", "--help"], repeats),
+        "dry_run": time_command([sys.executable, "evaluate.py", "--dry_run"], repeats),
+    }
+
+    failed = False
+
+    for name, times in results.items():
+        median = statistics.median(times)
+        print(f"{name}: median {median:.3f}s (min {min(times):.3f}s, max {max(times):.3f}s)")
+        failed |= median > max_seconds
+
+    heavy_modules = get_imported_heavy_modules()
+    print(f"heavy modules imported by evaluate.py: {heavy_modules}")
+    failed |= bool(heavy_modules)
+
+    if failed:
+        print(f"Startup latency check failed (limit {max_seconds:.2f}s, no heavy imports)")
+        sys.exit(1)
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--max_seconds", type=float, default=1.0)
+
+    args = parser.parse_args()
+
+    main(args.repeats, args.max_seconds)
@@ -0,0 +1,66 @@
+import time
+import random
+
+from argparse import ArgumentParser
+
+import numpy as np
+
+from tournament import Tournament
+
+def play_level_dicts(options, t, choices):
+    """One tournament level on per-figure lists of concept strings"""
+    for id in options:
+        option_list = options[id]["concepts"]
+        random.shuffle(option_list)
+        options[id]["concepts"] = [option_list[i:i+t] for i in range(0, len(option_list), t)]
+
+    for i in range(choices.shape[1]):
+        for j, id in enumerate(options):
+            try:
+                intermediate_answer = options[id]["concepts"][i][choices[j, i]-1]
+            except IndexError:
+                intermediate_answer = "None"
+            options[id]["concepts"][i] = intermediate_answer
+
+def play_level_arrays(tournament, t, choices, rng):
+    """One tournament level on a Tournament"""
+    brackets = tournament.create_brackets(t, rng)
+    tournament.select_winners(brackets, choices)
+
+def main(num_figures, num_concepts, t, repeats):
+
+    concepts = [f"concept {k}" for k in range(num_concepts)]
+    num_brackets = -(-num_concepts // t)
+
+    rng = np.random.default_rng(1337)
+    choices = rng.integers(1, t + 1, size=(num_figures, num_brackets))
+
+    results = {"dicts": [], "arrays": []}
+
+    for _ in range(repeats):
+        options = {f"F{j:010d}": {"concepts": list(concepts)} for j in range(num_figures)}
+        start = time.perf_counter()
+        play_level_dicts(options, t, choices)
+        results["dicts"].append(time.perf_counter() - start)
+
+        tournament = Tournament(concepts, [concepts] * num_figures)
+        start = time.perf_counter()
+        play_level_arrays(tournament, t, choices, rng)
+        results["arrays"].append(time.perf_counter() - start)
+
+    print(f"One level, {num_figures} figures, {num_concepts} concepts, t={t}")
+    for name, times in results.items():
+        print(f"{name}: {min(times)*1000:.1f} ms (best of {repeats})")
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+
+    parser.add_argument("--num_figures", type=int, default=10000)
+    parser.add_argument("--num_concepts", type=int, default=500)
+    parser.add_argument("--t", type=int, default=5)
+    parser.add_argument("--repeats", type=int, default=3)
+
+    args = parser.parse_args()
+
+    main(args.num_figures, args.num_concepts, args.t, args.repeats)
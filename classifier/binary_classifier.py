@@ -1,5 +1,9 @@
+import collections
+
+import torch
+
 from tqdm import tqdm
-from model_utils import generate
+from model_utils import generate, encode_images, score_answers
 
 def create_binary_question(template, concept):
     """
@@ -19,7 +23,69 @@ def create_binary_question(template, concept):
 
     return question
 
-def classify(model, loader, template, options):
+def ask(model, figures, questions, inference_method, image_embeds=None):
+    """
+        Query the LVLM with binary questions
+
+        Args:
+            model: LVLM to query
+            figures: figures to use in the query
+            questions: binary questions to use in the query
+            inference_method: "generate" for beam-search generation or
+                "likelihood" to score the 'yes'/'no' tokens in one decoder step
+            image_embeds: cached image embeddings of the figures (optional)
+
+        Returns:
+            answers: answer for each question
+            scores: score for each answer ('yes' probability for "likelihood")
+    """
+    if inference_method == "likelihood":
+        outputs, probabilities = score_answers(model, figures, questions, ["yes", "no"],
+                                               image_embeds=image_embeds)
+        return outputs, [p[0] for p in probabilities]
+
+    return generate(model, figures, questions, image_embeds=image_embeds)
+
+def record_answers(answers, ids, concepts, outputs, scores, reference_answers, log=None):
+    """Add the LVLM answers for one concept per figure to the answers dict (and the result log)"""
+    if log is not None:
+        log.append([
+            {"id": id, "concept": concept, "answer": answer, "score": score, "reference_answer": reference_answer}
+            for id, concept, answer, score, reference_answer in zip(ids, concepts, outputs, scores, reference_answers)
+        ])
+
+    for id, concept, answer, score, reference_answer in zip(ids, concepts, outputs, scores, reference_answers):
+        answers.setdefault(id, {
+            "reference_answer": reference_answer,
+            "generated_answer": answer,
+            "responses": []
+        })
+
+        if answer.lower() in ["y", "yes"]:
+            answers[id]["responses"].append(
+                (concept, score)
+            )
+
+def restore_answers(log):
+    """
+        Restore the answers from the result log of an interrupted run
+
+        Returns:
+            answers: answers dict of the logged results
+            done: set of the scored (figure id, classification label) pairs
+    """
+    answers = {}
+    done = set()
+
+    for record in log.read():
+        record_answers(answers, [record["id"]], [record["concept"]], [record["answer"]],
+                       [record["score"]], [record["reference_answer"]])
+        done.add((record["id"], record["concept"]))
+
+    return answers, done
+
+def classify(model, loader, template, options, cache_features=False, inference_method="generate",
+             rows_per_forward=None, log=None):
     """
         Classify the figures using binary classification approach
 
@@ -28,11 +94,21 @@ def classify(model, loader, template, options):
             loader: figures to classify
             template: binary classification template to use for classification
             options: all possible classification labels
+            cache_features: encode each figure once with the vision encoder and
+                reuse the features for all classification labels
+            inference_method: "generate" or "likelihood", see ask
+            rows_per_forward: maximum number of (figure, label) rows per forward
+                when cache_features is set, see classify_cached
+            log: ResultLog to persist the answers to; (figure, label) pairs
+                already in the log are not asked again
 
         Returns:
             List of answers for each figure for each classification label
     """
-    answers = {}
+    if cache_features:
+        return classify_cached(model, loader, template, options, inference_method, rows_per_forward, log)
+
+    answers, done = restore_answers(log) if log is not None else ({}, set())
 
     last_key = list(options.keys())[-1]
     num_of_concepts = len(options[last_key]["concepts"])
@@ -45,20 +121,229 @@ def classify(model, loader, template, options):
             figures = batch[1]
             reference_answers = batch[2]
 
-            questions = [create_binary_question(template, options[id]["concepts"][i]) for id in ids]
-            outputs, scores = generate(model, figures, questions)
+            if done:
+                keep = [j for j, id in enumerate(ids) if (id, options[id]["concepts"][i]) not in done]
+                if not keep: continue
+
+                ids = [ids[j] for j in keep]
+                figures = figures[keep]
+                reference_answers = [reference_answers[j] for j in keep]
 
-            for id, answer, score, reference_answer in zip(ids, outputs, scores, reference_answers):
-                answers.setdefault(id, {
-                    "reference_answer": reference_answer,
-                    "generated_answer": answer,
-                    "responses": []
-                })
+            concepts = [options[id]["concepts"][i] for id in ids]
+            questions = [create_binary_question(template, concept) for concept in concepts]
+            outputs, scores = ask(model, figures, questions, inference_method)
 
-                if answer.lower() in ["y", "yes"]:
-                    answers[id]["responses"].append(
-                        (options[id]["concepts"][i], score)
-                    )
+            record_answers(answers, ids, concepts, outputs, scores, reference_answers, log)
+
+    return answers
+
+def classify_cached(model, loader, template, options, inference_method="generate", rows_per_forward=None,
+                    log=None):
+    """
+        Classify the figures using binary classification approach
+
+        The loader is iterated once; the vision encoder features of a batch are
+        computed once and every figure is expanded into one (figure, label) row
+        per classification label sharing these features. The rows are packed
+        into forwards of at most rows_per_forward rows
+
+        Args:
+            model: LVLM to use for classification
+            loader: figures to classify
+            template: binary classification template to use for classification
+            options: all possible classification labels
+            inference_method: "generate" or "likelihood", see ask
+            rows_per_forward: maximum number of (figure, label) rows per forward,
+                defaults to the batch size (one label per figure per forward)
+            log: ResultLog to persist the answers to, see classify
+
+        Returns:
+            List of answers for each figure for each classification label
+    """
+    answers, done = restore_answers(log) if log is not None else ({}, set())
+
+    for batch in tqdm(loader):
+
+        ids = batch[0]
+        figures = batch[1]
+        reference_answers = batch[2]
+
+        rows = [(j, concept) for j, id in enumerate(ids) for concept in options[id]["concepts"]
+                    if (id, concept) not in done]
+        if not rows: continue
+
+        image_embeds = encode_images(model, figures)
+
+        step = rows_per_forward if rows_per_forward else len(ids)
+
+        for start in range(0, len(rows), step):
+
+            packed_rows = rows[start:start+step]
+            index = torch.tensor([j for j, _ in packed_rows], device=image_embeds.device)
+
+            row_ids = [ids[j] for j, _ in packed_rows]
+            row_reference_answers = [reference_answers[j] for j, _ in packed_rows]
+            concepts = [concept for _, concept in packed_rows]
+
+            questions = [create_binary_question(template, concept) for concept in concepts]
+            outputs, scores = ask(model, None, questions, inference_method,
+                                  image_embeds=image_embeds.index_select(0, index))
+
+            record_answers(answers, row_ids, concepts, outputs, scores, row_reference_answers, log)
+
+    return answers
+
+def frequency_prior(aspect):
+    """
+        Return a prior ordering the classification labels by their frequency
+        in the training split (most frequent first)
+
+        A prior is called with the LVLM, the image embeddings of the figures and
+        their classification labels and returns the labels of each figure in
+        the order to ask them; its num_queries attribute is the number of LVLM
+        queries it makes per figure
+
+        Raises:
+            ValueError: when the training split has no manifest
+    """
+    from dataset import get_manifest
+
+    manifest = get_manifest(aspect, split="train")
+
+    if manifest is None:
+        raise ValueError(f"The frequency prior needs the manifest of the {aspect} train split, "
+                         "use the open-ended prior for shards without a manifest")
+
+    counts = collections.Counter(manifest["labels"])
+
+    def prior(model, image_embeds, concept_lists):
+        return [sorted(concepts, key=lambda concept: -counts[concept]) for concepts in concept_lists]
+
+    prior.num_queries = 0
+    return prior
+
+def open_ended_prior(aspect, template):
+    """
+        Return a prior ordering the classification labels by PatentBERT
+        similarity to the answer of the LVLM to an open-ended question
+
+        Args:
+            aspect: aspect to classify for
+            template: open-ended classification template
+    """
+    from open_classifier import find_closest_concepts, get_concept_index
+
+    def prior(model, image_embeds, concept_lists):
+        questions = [template["question"] for _ in concept_lists]
+        outputs, _ = generate(model, None, questions, image_embeds=image_embeds)
+
+        ranked = find_closest_concepts(outputs, aspect, k=len(get_concept_index(aspect).concepts))
+
+        orders = []
+        for ranking, concepts in zip(ranked, concept_lists):
+            rank = {concept: r for r, concept in enumerate(ranking)}
+            orders.append(sorted(concepts, key=lambda concept: rank.get(concept, len(rank))))
+
+        return orders
+
+    prior.num_queries = 1
+    return prior
+
+def classify_adaptive(model, loader, template, options, prior, rows_per_forward=None,
+                      confidence_threshold=0.9, top_k=1, max_queries=None, log=None):
+    """
+        Classify the figures using binary classification approach with early exit
+
+        The classification labels of each figure are asked in the order given by
+        the prior. A figure is not asked further once top_k labels were answered
+        'yes' with a 'yes' probability of at least confidence_threshold, or after
+        max_queries questions. The questions are always scored with the
+        "likelihood" inference method, as beam search scores are log-probabilities
+        that cannot be compared to a threshold. The number of LVLM queries
+        (binary questions and prior) is stored per figure in "num_queries"
+
+        Args:
+            model: LVLM to use for classification
+            loader: figures to classify
+            template: binary classification template to use for classification
+            options: all possible classification labels
+            prior: function ordering the labels of the figures, e.g. frequency_prior
+            rows_per_forward: maximum number of (figure, label) rows per forward,
+                defaults to the batch size
+            confidence_threshold: minimum 'yes' probability of a confident answer
+            top_k: number of confident 'yes' answers to stop asking a figure
+            max_queries: maximum number of binary questions per figure (optional)
+            log: ResultLog to persist the answers to, see classify
+
+        Returns:
+            List of answers for each figure for the asked classification labels
+    """
+    answers, done = restore_answers(log) if log is not None else ({}, set())
+
+    def is_confident(id):
+        responses = answers.get(id, {}).get("responses", [])
+        return sum(score >= confidence_threshold for _, score in responses) >= top_k
+
+    for batch in tqdm(loader):
+
+        ids = batch[0]
+        figures = batch[1]
+        reference_answers = batch[2]
+
+        # binary questions asked per figure (including the ones restored from the log)
+        asked = {id: sum((id, concept) in done for concept in options[id]["concepts"]) for id in ids}
+
+        active = [j for j, id in enumerate(ids) if not is_confident(id)
+                    and (max_queries is None or asked[id] < max_queries)
+                    and asked[id] < len(options[id]["concepts"])]
+
+        if active:
+            ids = [ids[j] for j in active]
+            reference_answers = [reference_answers[j] for j in active]
+
+            image_embeds = encode_images(model, figures[active])
+
+            orders = prior(model, image_embeds, [options[id]["concepts"] for id in ids])
+            queues = [[concept for concept in order if (id, concept) not in done] for id, order in zip(ids, orders)]
+
+            step = rows_per_forward if rows_per_forward else len(ids)
+            active = list(range(len(ids)))
+
+        while active:
+
+            per_figure = max(1, step // len(active))
+
+            packed_rows = []
+            for j in active:
+                limit = per_figure if max_queries is None else min(per_figure, max_queries - asked[ids[j]])
+                packed_rows.extend((j, concept) for concept in queues[j][:limit])
+                queues[j] = queues[j][limit:]
+
+            for start in range(0, len(packed_rows), step):
+
+                rows = packed_rows[start:start+step]
+                index = torch.tensor([j for j, _ in rows], device=image_embeds.device)
+
+                row_ids = [ids[j] for j, _ in rows]
+                row_reference_answers = [reference_answers[j] for j, _ in rows]
+                concepts = [concept for _, concept in rows]
+
+                questions = [create_binary_question(template, concept) for concept in concepts]
+                outputs, scores = ask(model, None, questions, "likelihood",
+                                      image_embeds=image_embeds.index_select(0, index))
+
+                record_answers(answers, row_ids, concepts, outputs, scores, row_reference_answers, log)
+
+            for j, _ in packed_rows:
+                asked[ids[j]] += 1
+
+            active = [j for j in active if queues[j] and not is_confident(ids[j])
+                        and (max_queries is None or asked[ids[j]] < max_queries)]
+
+        # figures skipped on resume keep the count of their logged questions
+        for id, count in asked.items():
+            if id in answers:
+                answers[id]["num_queries"] = count + prior.num_queries
 
     return answers
 
@@ -95,4 +380,8 @@ def compute_accuracy(answers):
     print()
     print(f"{accuracy:.2f}%")
 
+    if any("num_queries" in sample for sample in answers.values()):
+        queries = sum(sample.get("num_queries", 0) for sample in answers.values()) / len(answers)
+        print(f"{queries:.2f} queries per figure")
+
     return answers
\ No newline at end of file
@@ -1,6 +1,9 @@
+import os
 import json
 import yaml
 
+from profiling import profiled
+
 def get_config():
     return yaml.safe_load(open("config.yaml"))
 
@@ -22,6 +25,7 @@ def load_json(file):
 
     with open(file, 'r') as f: return json.load(f)
 
+@profiled("save_json")
 def save_json(file, data):
     """
         Save data as JSON file
@@ -33,11 +37,14 @@ def save_json(file, data):
         Returns:
             None
     """
-    with open(file, 'w') as f: json.dump(data, f, indent=4)
+    # write to a temporary file first so an interrupted save leaves no partial file
+    with open(f"{file}.tmp", 'w') as f: json.dump(data, f, indent=4)
+    os.replace(f"{file}.tmp", file)
 
 EXPERIMENTS = {
     "traditional": {},
     "bc": {},
+    "hbc": {},
     "oc": {},
     "mc-ts": {}
 }
@@ -48,6 +55,7 @@ for aspect in ASPECTS:
     experiment = f"{aspect}/"
     EXPERIMENTS["traditional"][experiment_id] = experiment
     EXPERIMENTS["bc"][experiment_id] = experiment
+    EXPERIMENTS["hbc"][experiment_id] = experiment
     EXPERIMENTS["oc"][experiment_id] = experiment
     experiment_id += 1
 
@@ -1,7 +1,11 @@
 import os
-import io
+import re
+import sys
+import json
+import shutil
+import hashlib
 
-from PIL import Image
+import numpy as np
 
 import torch
 import torchvision.transforms as T
@@ -9,7 +13,13 @@ import torchvision.transforms as T
 from braceexpand import braceexpand
 import webdataset as wds
 
-from common_utils import get_config
+from common_utils import get_config, load_json
+from profiling import timer, TimedIterable
+
+# shard_reader.py is in the dataset directory
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dataset"))
+
+from shard_reader import IMAGE_KEYS, BlobIndexDataset, load_image
 
 config = get_config()
 
@@ -29,31 +39,208 @@ class EvalWebDataset:
         self.aspect = aspect
         self.transform = transform if transform else T.Compose([lambda x: x])
         self.split = split + "_150" if split == "train" else split
-        data_dir = f"classification/{aspect}/{self.split}/"
-        shard_count = f"{(len(os.listdir(data_dir))-1):06d}"
-        self.shards = braceexpand(data_dir+"shard-{000000.."+shard_count+"}.tar")
+        self.data_dir = f"classification/{aspect}/{self.split}/"
+        self.index_path = os.path.join(self.data_dir, "index.json")
+
+        if os.path.isfile(self.index_path): # blob layout
+            self.shards = []
+        else:
+            shard_files = [f for f in os.listdir(self.data_dir) if f.startswith("shard-") and f.endswith(".tar")]
+            shard_count = f"{(len(shard_files)-1):06d}"
+            self.shards = list(braceexpand(self.data_dir+"shard-{000000.."+shard_count+"}.tar"))
+
+    def get_manifest(self):
+        """
+            Return the manifest of the split (keys, labels and shard offsets)
+
+            Returns None for shards created without a manifest
+        """
+        manifest_path = os.path.join(self.data_dir, "manifest.json")
+        return load_json(manifest_path) if os.path.isfile(manifest_path) else None
 
     def get_wds(self):
         """
-            Return the dataset as webdataset
+            Return the dataset as webdataset (or BlobIndexDataset for the blob layout)
         """
+        if not self.shards:
+            return BlobIndexDataset(self.index_path, self.decode_image, lambda label: label, timer=timer)
+
         return (wds.WebDataset(self.shards)
                     .shuffle(0)
-                    .to_tuple("__key__", "image.png", "label.txt")
+                    .to_tuple("__key__", IMAGE_KEYS, "label.txt")
                     .map_tuple(
                         lambda key: key,
-                        lambda image: self.transform(Image.open(io.BytesIO(image))),
+                        self.decode_image,
                         lambda label: label.decode("utf-8")
                     ))
 
+    def decode_image(self, image):
+        """
+            Decode a figure and apply the transform (e.g. vis_preprocess)
+        """
+        with timer("decode"):
+            image = load_image(image)
+
+        with timer("preprocess"):
+            return self.transform(image)
+
+def describe_transform(transform):
+    """
+        Return a description of a transform that is stable across runs
+
+        Object and function reprs contain memory addresses, which are removed;
+        the wrapped transform of a LAVIS processor (its transform attribute,
+        e.g. Resize, ToTensor and Normalize with their parameters) is included
+    """
+    description = re.sub(r" at 0x[0-9a-fA-F]+", "", repr(transform))
+
+    if hasattr(transform, "transform"):
+        description += f"({describe_transform(transform.transform)})"
+
+    return description
+
+class TensorCache(torch.utils.data.Dataset):
+    """
+        On-disk cache of preprocessed PatFigCLS figures
+
+        The figures of a split are decoded and preprocessed once and stored as
+        a memory-mapped array; later iterations read the tensors from the
+        array without decoding the shards again. The cache lives in a directory
+        named after a fingerprint of the shards and the transform, so changed
+        shards or preprocessing use a new cache; the caches of older
+        fingerprints of the split are removed once a new cache is built
+    """
+    def __init__(self, dataset, cache_dir, dtype="float16"):
+        self.dataset = dataset
+        self.dtype = dtype
+        self.path = os.path.join(cache_dir, dataset.aspect, dataset.split, self.get_fingerprint())
+        self.index = None
+        self.images = None
+
+    def get_fingerprint(self):
+        """
+            Return a fingerprint of the shards (path, size, modification time),
+            the transform and the storage dtype
+        """
+        files = self.dataset.shards or [self.dataset.index_path]
+        shards = [(shard, os.path.getsize(shard), os.path.getmtime(shard)) for shard in files]
+        data = json.dumps({"shards": shards, "transform": describe_transform(self.dataset.transform),
+                           "dtype": self.dtype})
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()[:16]
+
+    def is_built(self):
+        return os.path.isfile(os.path.join(self.path, "index.json"))
+
+    def build(self):
+        """
+            Decode and preprocess all figures of the split into the cache
+        """
+        loader = wds.WebLoader(self.dataset.get_wds(), shuffle=False, num_workers=num_workers,
+                               batch_size=batch_size)
+
+        tmp_path = self.path + ".tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+
+        index = {"keys": [], "labels": [], "shape": None, "dtype": self.dtype}
+
+        with open(os.path.join(tmp_path, "images.bin"), "wb") as f:
+            for ids, figures, labels in loader:
+                figures = figures.numpy().astype(self.dtype)
+                f.write(figures.tobytes())
+
+                index["keys"].extend(ids)
+                index["labels"].extend(labels)
+                index["shape"] = list(figures.shape[1:])
+
+        with open(os.path.join(tmp_path, "index.json"), "w") as f:
+            json.dump(index, f)
+
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(tmp_path, self.path)
+
+        # caches of older fingerprints of the split are stale
+        split_dir = os.path.dirname(self.path)
+        for name in os.listdir(split_dir):
+            if name != os.path.basename(self.path) and re.fullmatch(r"[0-9a-f]{16}", name):
+                shutil.rmtree(os.path.join(split_dir, name), ignore_errors=True)
+
+    def load(self):
+        """
+            Build the cache if needed and read its index
+        """
+        if not self.is_built():
+            print(f"Building tensor cache {self.path}")
+            self.build()
+
+        self.index = load_json(os.path.join(self.path, "index.json"))
+        return self
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["images"] = None # reopened by each loader worker
+        return state
+
+    def __len__(self):
+        return len(self.index["keys"])
+
+    def __getitem__(self, i):
+        if self.images is None:
+            self.images = np.memmap(os.path.join(self.path, "images.bin"), mode="c",
+                                    dtype=self.index["dtype"],
+                                    shape=(len(self), *self.index["shape"]))
+
+        return self.index["keys"][i], torch.from_numpy(self.images[i]), self.index["labels"][i]
+
 def get_dataloader(aspect, transform):
     """
         Return WebLoader for PatFIGCLS dataset
+
+        When tensor_cache_dir is set in the config, the preprocessed figures
+        are read from a TensorCache instead of the shards
     """
     eval_dataset = EvalWebDataset(aspect, split="test", transform=transform)
-                    
-    loader = wds.WebLoader(eval_dataset.get_wds(),
-                shuffle=False, num_workers=num_workers,
-                batch_size=batch_size, pin_memory=True)
-    
-    return loader
+
+    if config.get("tensor_cache_dir"):
+        cache = TensorCache(eval_dataset, config["tensor_cache_dir"],
+                            dtype=config.get("tensor_cache_dtype", "float16")).load()
+
+        loader = torch.utils.data.DataLoader(cache, shuffle=False, num_workers=num_workers,
+                                             batch_size=batch_size, pin_memory=True)
+    else:
+        loader = wds.WebLoader(eval_dataset.get_wds(),
+                    shuffle=False, num_workers=num_workers,
+                    batch_size=batch_size, pin_memory=True)
+
+    # time spent waiting for batches (reading, decoding and preprocessing in the workers)
+    return TimedIterable(loader, "dataloader_wait")
+
+def get_manifest(aspect, split="test"):
+    """
+        Return the manifest of the PatFIGCLS split without reading any image
+    """
+    return EvalWebDataset(aspect, split=split).get_manifest()
+
+def get_ids(aspect, loader, split="test"):
+    """
+        Return the figure ids of the split in shard order
+
+        The ids are read from the manifest; for shards without a manifest the
+        loader is iterated instead
+    """
+    manifest = get_manifest(aspect, split)
+
+    if manifest is not None:
+        return manifest["keys"]
+
+    return [id for batch in loader for id in batch[0]]
+
+def get_labels(aspect, loader, split="test"):
+    """
+        Return the reference labels of the split in shard order
+    """
+    manifest = get_manifest(aspect, split)
+
+    if manifest is not None:
+        return manifest["labels"]
+
+    return [label for batch in loader for label in batch[2]]
\ No newline at end of file
@@ -1,16 +1,15 @@
 import os
+import gc
 
 import random
 import logging
 
+from argparse import ArgumentParser
+
 import warnings
 warnings.filterwarnings('ignore', category=UserWarning)
 
-import torch
-
-from model_utils import get_model_and_preprocess
-
-from dataset import get_dataloader
+import profiling
 
 from metadata import get_options, get_template
 from common_utils import save_json, get_config, EXPERIMENTS
@@ -20,78 +19,246 @@ logging.basicConfig(level=logging.INFO)
 
 os.environ['TOKENIZERS_PARALLELISM'] = 'false'
 
-device = torch.device("cuda") if torch.cuda.is_available() else "cpu"
+# torch, LAVIS and the datasets are imported in the functions using them,
+# so that --help and --dry_run start without loading them
 
 # selected models
+# (the hierarchical classifier asks the same binary questions as bc and uses its models)
 N = {
-    'type': {'bc': '54', 'mc-ts': '81', 'oc': '81'}, 
-    'projection': {'bc': '81', 'mc-ts': '18', 'oc': '81'}, 
-    'uspc': {'bc': '27', 'mc-ts': '81', 'oc': '54'},
-    'object': {'bc': '150', 'mc-ts': '150', 'oc': '81'}
+    'type': {'bc': '54', 'hbc': '54', 'mc-ts': '81', 'oc': '81'}, 
+    'projection': {'bc': '81', 'hbc': '81', 'mc-ts': '18', 'oc': '81'}, 
+    'uspc': {'bc': '27', 'hbc': '27', 'mc-ts': '81', 'oc': '54'},
+    'object': {'bc': '150', 'hbc': '150', 'mc-ts': '150', 'oc': '81'}
 }
 
-def main(classifier):
+def get_schedule(classifiers):
+    """
+        Return the experiments to run for the classifiers
+
+        Experiments using the same model are grouped so they run back-to-back
+        and the model is loaded only once
 
+        Args:
+            classifiers: classifiers to run experiments for
+
+        Returns:
+            List of experiments (classifier, model name, experiment, model directory,
+            results directory)
+    """
     config = get_config()
 
+    MODELS = config["models"]
+    dataset = config["dataset"]
+
+    schedule = []
+
+    for classifier in classifiers:
+
+        for model_name in MODELS:
+
+            for experiment_id, experiment in EXPERIMENTS[classifier].items():
+
+                aspect = experiment.split("/")[0]
+
+                if model_name == "flant5xl_zs_all_tasks":
+                    _model_name = "flant5xl_zs_all_tasks"
+                    model_dir = None
+                else:
+                    _aspect = "object" if aspect == "object_held_out" else aspect
+                    _model_name = model_name.format(_aspect, N[_aspect][classifier])
+                    model_dir = f"LAVIS/lavis/outputs/instructblip/"
+                    model_dir += f"{dataset}_{_model_name}"
+
+                schedule.append({
+                    "classifier": classifier,
+                    "model_name": _model_name,
+                    "experiment": experiment,
+                    "model_dir": model_dir,
+                    "save_dir": f"results/classification/{classifier}/{_model_name}/{experiment}"
+                })
+
+    # stable sort keeps the original order within a model
+    model_order = {}
+    for run in schedule:
+        model_order.setdefault(run["model_dir"], len(model_order))
+
+    return sorted(schedule, key=lambda run: model_order[run["model_dir"]])
+
+def is_complete(run):
+    """Return True if the answers of the experiment were saved"""
+    return os.path.isfile(f"{run['save_dir']}/answers.json")
+
+def run_experiment(run, model, vis_preprocess, config, resume=False):
+    """
+        Run a classification experiment and save the answers
+
+        Args:
+            run: experiment from get_schedule
+            model: LVLM to use for classification
+            vis_preprocess: visual preprocessing function of the model
+            config: evaluation config
+            resume: continue from the result log of an interrupted run
+    """
+    import torch
+
+    from dataset import get_dataloader, get_ids
+    from result_log import ResultLog
+
+    classifier = run["classifier"]
+    experiment = run["experiment"]
+
+    if config["profile"]:
+        profiling.enable(trace=config["profile_trace"])
+
     random.seed(config["seed"])
     torch.manual_seed(config["seed"])
 
-    MODELS = config["models"]
-    dataset = config["dataset"]
+    aspect = experiment.split("/")[0]
+    template = get_template(
+                    classifier, 
+                    "object" if aspect == "object_held_out" else aspect
+                )
+
+    loader = get_dataloader(aspect, vis_preprocess)
+    options = get_options(aspect, get_ids(aspect, loader))
+
+    save_dir = run["save_dir"]
+    os.makedirs(save_dir, exist_ok=True)
+    log = ResultLog(f"{save_dir}/answers.jsonl", resume=resume)
+
+    if classifier == "bc":
+        from binary_classifier import classify, classify_adaptive, compute_accuracy
+        from binary_classifier import frequency_prior, open_ended_prior
 
-    for model_name in MODELS:
+        if config["adaptive_prior"]:
+            if config["adaptive_prior"] == "open-ended":
+                prior = open_ended_prior(
+                    aspect,
+                    get_template("oc", "object" if aspect == "object_held_out" else aspect)
+                )
+            else:
+                prior = frequency_prior(aspect)
+
+            answers = classify_adaptive(model, loader, template, options, prior,
+                                        rows_per_forward=config["rows_per_forward"],
+                                        confidence_threshold=config["confidence_threshold"],
+                                        top_k=config["confident_answers"],
+                                        max_queries=config["max_queries"],
+                                        log=log)
+        else:
+            answers = classify(model, loader, template, options,
+                               cache_features=config["cache_image_features"],
+                               inference_method=config["inference_method"],
+                               rows_per_forward=config["rows_per_forward"],
+                               log=log)
+        compute_accuracy(answers)
+
+    if classifier == "hbc":
+        from hierarchical_classifier import classify, get_concept_groups
+        from binary_classifier import compute_accuracy
+        from metadata import get_concepts
+
+        groups = get_concept_groups(aspect, get_concepts(aspect), config["num_groups"])
+
+        answers = classify(model, loader, template, groups, config["group_beam"],
+                           inference_method=config["inference_method"],
+                           rows_per_forward=config["rows_per_forward"],
+                           log=log)
+        compute_accuracy(answers)
+
+    if classifier == "mc-ts":
+        from mc_tournament_classifier import classify, compute_accuracy
+        
+        level = 0
+        t = experiment.split("/")[1]
+        t = int(t.split("O")[1])
+
+        answers = classify(model, loader, template, options, t, level,
+                           inference_method=config["inference_method"],
+                           log=log,
+                           rows_per_forward=config["rows_per_forward"])
+        compute_accuracy(answers)
 
-        for experiment_id, experiment in EXPERIMENTS[classifier].items():
+    if classifier == "oc":
+        from open_classifier import classify, classify_served, compute_accuracy, get_embedding_model_id
+        from answer_cache import AnswerCache
 
-            aspect = experiment.split("/")[0]
-            template = get_template(
-                            classifier, 
-                            "object" if aspect == "object_held_out" else aspect
-                        )
+        cache = None
+        if config["answer_cache_path"]:
+            cache = AnswerCache(config["answer_cache_path"], get_embedding_model_id())
 
-            if model_name == "flant5xl_zs_all_tasks":
-                _model_name = "flant5xl_zs_all_tasks"
-                model_dir = None
+        try:
+            if config["inference_server"]:
+                answers = classify_served(model, loader, template, aspect,
+                                          max_batch_size=config["max_batch_size"],
+                                          max_wait=config["max_wait_ms"] / 1000,
+                                          cache=cache, log=log)
             else:
-                _aspect = "object" if aspect == "object_held_out" else aspect
-                _model_name = model_name.format(_aspect, N[_aspect][classifier])
-                model_dir = f"LAVIS/lavis/outputs/instructblip/"
-                model_dir += f"{dataset}_{_model_name}"
-
-            print(f"Running experiment: {_model_name}/{classifier}/{experiment}")
-                
-            model, vis_preprocess = get_model_and_preprocess(model_dir)
-
-            loader = get_dataloader(aspect, vis_preprocess)
-            options = get_options(aspect, loader)
-
-            if classifier == "bc":
-                from binary_classifier import classify, compute_accuracy
-                
-                answers = classify(model, loader, template, options)
-                compute_accuracy(answers)
-
-            if classifier == "mc-ts":
-                from mc_tournament_classifier import classify, compute_accuracy
-                
-                level = 0
-                t = experiment.split("/")[1]
-                t = int(t.split("O")[1])
-
-                answers = classify(model, loader, template, options, t, level)
-                compute_accuracy(answers)
-
-            if classifier == "oc":
-                from open_classifier import classify, compute_accuracy
-                answers = classify(model, loader, template, aspect)
-                compute_accuracy(answers)
-
-            save_dir = f"results/classification/{classifier}/{_model_name}/{experiment}"
-            os.makedirs(save_dir, exist_ok=True)
-            save_json(f"{save_dir}/answers.json", answers)
+                answers = classify(model, loader, template, aspect, cache=cache, log=log)
+        finally:
+            # one SQLite connection per experiment, not kept across the schedule
+            if cache is not None: cache.close()
+
+        compute_accuracy(answers)
+
+    save_json(f"{save_dir}/answers.json", answers)
+    log.close(remove=True)
+
+    profiler = profiling.disable()
+    if profiler is not None:
+        profiler.print_summary()
+        save_json(f"{save_dir}/profile.json", profiler.summary())
+        if profiler.trace:
+            profiler.save_trace(f"{save_dir}/trace.json")
+
+def main(classifiers, dry_run=False, resume=False):
+
+    config = get_config()
+
+    schedule = get_schedule(classifiers)
+
+    if resume:
+        schedule = [run for run in schedule if not is_complete(run)]
+
+    if dry_run:
+        for run in schedule:
+            print(f"{run['model_name']}/{run['classifier']}/{run['experiment']} ({run['model_dir']})")
+        return
+
+    from model_utils import ModelPool
+
+    model_pool = ModelPool(config["model_pool_budget_gb"], cpu_options={
+        "quantize": config["cpu_quantization"],
+        "bf16_vision": config["cpu_bf16_vision"],
+        "num_threads": config["cpu_threads"]
+    })
+
+    model = vis_preprocess = None
+
+    for run in schedule:
+
+        print(f"Running experiment: {run['model_name']}/{run['classifier']}/{run['experiment']}")
+
+        # drop the reference to the previous model, so the pool can free it on eviction
+        model = vis_preprocess = None
+        gc.collect()
+
+        model, vis_preprocess = model_pool.get(run["model_dir"])
+
+        run_experiment(run, model, vis_preprocess, config, resume=resume)
 
 if __name__ == "__main__":
 
-    for classifier in ["bc", "oc", "mc-ts"]:
-        main(classifier)
+    parser = ArgumentParser()
+
+    parser.add_argument("--classifiers", nargs="+", default=["bc", "oc", "mc-ts"],
+                        choices=["bc", "hbc", "oc", "mc-ts"])
+    parser.add_argument("--dry_run", action="store_true",
+                        help="print the experiment schedule without running it")
+
+    parser.add_argument("--resume", action="store_true",
+                        help="skip completed experiments and continue interrupted ones")
+
+    args = parser.parse_args()
+
+    main(args.classifiers, dry_run=args.dry_run, resume=args.resume)
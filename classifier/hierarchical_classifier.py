@@ -0,0 +1,225 @@
+import os
+import math
+import collections
+
+import torch
+import numpy as np
+
+from tqdm import tqdm
+
+from model_utils import encode_images
+from binary_classifier import ask, create_binary_question, record_answers, restore_answers
+from common_utils import load_json, save_json, get_config
+
+config = get_config()
+
+def cluster_concepts(embeddings, num_groups, seed, iterations=50):
+    """
+        Run spherical k-means on normalised concept embeddings
+
+        Args:
+            embeddings: (C, D) normalised embeddings
+            num_groups: number of clusters
+            seed: seed of the initial centroids
+            iterations: maximum number of assignment/update steps
+
+        Returns:
+            Cluster id of each embedding
+    """
+    rng = np.random.default_rng(seed)
+    centroids = embeddings[rng.choice(len(embeddings), num_groups, replace=False)]
+    assignments = None
+
+    for _ in range(iterations):
+        new_assignments = (embeddings @ centroids.T).argmax(axis=1)
+        if assignments is not None and np.array_equal(assignments, new_assignments): break
+        assignments = new_assignments
+
+        for k in range(num_groups):
+            members = embeddings[assignments == k]
+            if len(members) == 0: continue
+            centroid = members.mean(axis=0)
+            centroids[k] = centroid / max(np.linalg.norm(centroid), 1e-12)
+
+    return assignments
+
+def build_concept_groups(aspect, num_groups=None):
+    """
+        Group the concepts of an aspect by PatentBERT similarity
+
+        The representative of a group is the member closest to the centroid
+        (the rule of find_representative_concept in
+        dataset/concepts/cluster_object_concepts.py, which clusters raw labels
+        into the classification concepts, not the concepts into groups)
+
+        Args:
+            aspect: aspect to group the concepts of
+            num_groups: number of groups, defaults to sqrt of the number of concepts
+
+        Returns:
+            Dictionary of group representative to group members
+    """
+    from open_classifier import get_concept_index
+
+    index = get_concept_index(aspect)
+    embeddings = index.matrix.astype(np.float32)
+
+    num_groups = num_groups or round(math.sqrt(len(index.concepts)))
+    num_groups = max(1, min(num_groups, len(index.concepts)))
+
+    assignments = cluster_concepts(embeddings, num_groups, config["seed"])
+
+    groups = {}
+    for k in np.unique(assignments):
+        member_indices = np.where(assignments == k)[0]
+
+        centroid = embeddings[member_indices].mean(axis=0)
+        representative = index.concepts[member_indices[np.argmax(embeddings[member_indices] @ centroid)]]
+
+        groups[representative] = [index.concepts[i] for i in member_indices]
+
+    return groups
+
+def get_concept_groups(aspect, concepts, num_groups=None):
+    """
+        Return the concept groups of an aspect
+
+        Groups in {cls_dataset_path}/{aspect}/concept_groups.json (representative
+        to member concepts, e.g. curated by hand) are used if the file exists;
+        concepts missing from the file become single-member groups. Otherwise
+        the groups are built with build_concept_groups and saved to
+        concept_groups_dir
+
+        Args:
+            aspect: aspect to classify for
+            concepts: classification labels of the aspect
+            num_groups: number of groups to build (optional)
+
+        Returns:
+            Dictionary of group representative to group members
+    """
+    path = f"{config['cls_dataset_path']}/{aspect}/concept_groups.json"
+
+    if not os.path.isfile(path):
+        from open_classifier import get_concept_index
+
+        fingerprint = get_concept_index(aspect).fingerprint
+        path = f"{config['concept_groups_dir']}/{aspect}_{fingerprint}_{num_groups or 'sqrt'}.json"
+
+        if not os.path.isfile(path):
+            os.makedirs(config["concept_groups_dir"], exist_ok=True)
+            save_json(path, build_concept_groups(aspect, num_groups))
+
+    concept_set = set(concepts)
+    groups = {}
+
+    for representative, members in load_json(path).items():
+        members = [member for member in members if member in concept_set]
+        if not members: continue
+        if representative not in concept_set: representative = members[0]
+        groups[representative] = members
+
+    grouped = {member for members in groups.values() for member in members}
+    for concept in concepts:
+        if concept not in grouped: groups[concept] = [concept]
+
+    return groups
+
+def classify(model, loader, template, groups, beam=2, inference_method="generate", rows_per_forward=None,
+             log=None):
+    """
+        Classify the figures using coarse-to-fine binary classification
+
+        Each figure is first asked about the representative of every group; the
+        beam groups with the most confident 'yes' (or least confident 'no')
+        answers are kept and only their members are asked next. With about
+        sqrt(C) groups this asks O(sqrt(C)) binary questions per figure instead
+        of C. The number of LVLM queries is stored per figure in "num_queries"
+
+        Args:
+            model: LVLM to use for classification
+            loader: figures to classify
+            template: binary classification template to use for classification
+            groups: dictionary of group representative to group members, see get_concept_groups
+            beam: number of groups to keep per figure
+            inference_method: "generate" or "likelihood", see binary_classifier.ask
+            rows_per_forward: maximum number of (figure, label) rows per forward,
+                defaults to the batch size
+            log: ResultLog to persist the answers to; (figure, label) pairs
+                already in the log are not asked again
+
+        Returns:
+            List of answers for each figure for the asked classification labels
+    """
+    answers, _ = restore_answers(log) if log is not None else ({}, set())
+    asked = {(record["id"], record["concept"]): (record["answer"], record["score"])
+                for record in log.read()} if log is not None else {}
+    queries = collections.Counter(id for id, _ in asked)
+
+    representatives = list(groups.keys())
+
+    def pending(ids, rows):
+        """Return the (figure index, label) rows not asked before"""
+        return [(j, concept) for j, concept in rows if (ids[j], concept) not in asked]
+
+    def ask_rows(ids, reference_answers, image_embeds, rows):
+        """Ask the (figure index, label) rows"""
+        step = rows_per_forward if rows_per_forward else len(ids)
+
+        for start in range(0, len(rows), step):
+
+            packed_rows = rows[start:start+step]
+            index = torch.tensor([j for j, _ in packed_rows], device=image_embeds.device)
+
+            row_ids = [ids[j] for j, _ in packed_rows]
+            row_reference_answers = [reference_answers[j] for j, _ in packed_rows]
+            concepts = [concept for _, concept in packed_rows]
+
+            questions = [create_binary_question(template, concept) for concept in concepts]
+            outputs, scores = ask(model, None, questions, inference_method,
+                                  image_embeds=image_embeds.index_select(0, index))
+
+            record_answers(answers, row_ids, concepts, outputs, scores, row_reference_answers, log)
+
+            for id, concept, output, score in zip(row_ids, concepts, outputs, scores):
+                asked[(id, concept)] = (output, score)
+                queries[id] += 1
+
+    def group_score(id, representative):
+        """Rank by 'yes' probability, or 'yes' answers by score before 'no' answers by lowest score"""
+        answer, score = asked[(id, representative)]
+        if inference_method == "likelihood": return (score,)
+        return (1, score) if answer.lower() in ["y", "yes"] else (0, -score)
+
+    def member_rows(ids):
+        """Return the rows of the members of the kept groups, once all representatives are asked"""
+        rows = []
+        for j, id in enumerate(ids):
+            kept = sorted(representatives, key=lambda representative: group_score(id, representative),
+                          reverse=True)[:beam]
+            rows.extend((j, member) for representative in kept for member in groups[representative])
+        return rows
+
+    for batch in tqdm(loader):
+
+        ids = batch[0]
+        figures = batch[1]
+        reference_answers = batch[2]
+
+        # coarse: one question per group
+        coarse_rows = pending(ids, [(j, representative) for j in range(len(ids)) for representative in representatives])
+
+        # figures fully answered in the result log are not encoded again
+        if coarse_rows or pending(ids, member_rows(ids)):
+
+            image_embeds = encode_images(model, figures)
+
+            ask_rows(ids, reference_answers, image_embeds, coarse_rows)
+
+            # fine: the members of the kept groups
+            ask_rows(ids, reference_answers, image_embeds, pending(ids, member_rows(ids)))
+
+        for id in ids:
+            answers[id]["num_queries"] = queries[id]
+
+    return answers
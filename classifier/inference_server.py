@@ -0,0 +1,110 @@
+import time
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from model_utils import generate
+
+class InferenceServer:
+    """
+        In-process LVLM server batching (figure, question) requests
+
+        Requests are queued and coalesced into batches of at most max_batch_size
+        requests, waiting at most max_wait seconds after the first request of a
+        batch for more requests. The model runs on a dedicated thread, so the
+        event loop keeps accepting requests and running the callers (data
+        loading, prompt building, post-processing) while a batch is computed
+
+        Usage:
+            async with InferenceServer(model, 128, 0.01) as server:
+                answer, score = await server.submit(figure, question)
+    """
+    def __init__(self, model, max_batch_size=128, max_wait=0.01):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.queue = None
+        self.worker = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    def start(self):
+        """Start the batching loop on the running event loop"""
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.get_running_loop().create_task(self.serve())
+
+    async def stop(self):
+        """Finish the queued requests and stop the batching loop"""
+        await self.queue.join()
+        self.worker.cancel()
+
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+
+        self.executor.shutdown()
+
+    async def submit(self, figure, question):
+        """
+            Queue a request and wait for its answer
+
+            Args:
+                figure: preprocessed image
+                question: question about the figure
+
+            Returns:
+                answer: output text generated by the LVLM
+                score: text probability score of the answer
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((figure, question, future))
+        return await future
+
+    async def next_batch(self):
+        """Wait for a request and collect more until the batch is full or max_wait elapsed"""
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0: break
+
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def serve(self):
+        """Batching loop: run the model on each batch and resolve the request futures"""
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = await self.next_batch()
+
+            try:
+                figures = torch.stack([figure for figure, _, _ in batch])
+                questions = [question for _, question, _ in batch]
+
+                answers, scores = await loop.run_in_executor(self.executor, generate, self.model,
+                                                             figures, questions)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done(): future.set_exception(e)
+            else:
+                for (_, _, future), answer, score in zip(batch, answers, scores):
+                    if not future.done(): future.set_result((answer, score))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
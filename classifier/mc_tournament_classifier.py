@@ -1,7 +1,13 @@
 import re
 import random
 
-from model_utils import generate, postprocess
+import torch
+import numpy as np
+
+from tqdm import tqdm
+
+from model_utils import generate, postprocess, score_answers, encode_images
+from tournament import Tournament
 
 random.seed(1337)
 
@@ -25,80 +31,172 @@ def create_multiple_choice_question(template, options_list):
 
     return question
 
-def classify(model, loader, template, options, t, level):
+def ask(model, figures, questions, option_lists, inference_method, image_embeds=None):
     """
-        Classify the figures using multiple-choice tournament classification approach
+        Query the LVLM with multiple-choice questions
+
+        Args:
+            model: LVLM to query
+            figures: figures to use in the query
+            questions: multiple-choice questions to use in the query
+            option_lists: classification labels listed in each question
+            inference_method: "generate" for beam-search generation or
+                "likelihood" to score the option number tokens in one decoder step
+            image_embeds: cached image embeddings of the figures (optional)
+
+        Returns:
+            Answer for each question
+    """
+    if inference_method == "likelihood":
+        num_candidates = [len(option_list) for option_list in option_lists]
+        candidates = [str(i+1) for i in range(max(num_candidates))]
+        outputs, _ = score_answers(model, figures, questions, candidates,
+                                   image_embeds=image_embeds, num_candidates=num_candidates)
+        return outputs
+
+    outputs, _ = generate(model, figures, questions, image_embeds=image_embeds)
+    return outputs
+
+def play_tournament(model, image_embeds, ids, reference_answers, template, options, t, rng, level=0,
+                    inference_method="generate", rows_per_forward=None):
+    """
+        Play all levels of the tournament for a batch of figures
+
+        The brackets of a level of all figures in the batch are asked together,
+        reusing the image embeddings of the figures for every level. The
+        tournament state is kept as concept id arrays (see Tournament) and
+        written back to options at the end
 
         Args:
             model: LVLM to use for classification
-            loader: figures to classify
+            image_embeds: image embeddings of the figures from encode_images
+            ids: ids of the figures
+            reference_answers: reference labels of the figures
             template: multiple-choice classification template to use for classification
-            options: all possible classification labels
+            options: all possible classification labels, updated in place
             t: number of options to use
-            level: round of tournament
+            rng: NumPy random generator to shuffle the brackets
+            level: round of tournament to start from
+            inference_method: "generate" or "likelihood", see ask
+            rows_per_forward: maximum number of (figure, bracket) rows per forward,
+                defaults to the batch size
+    """
+    option_lists = [options[id]["concepts"] for id in ids]
+    concepts = list(dict.fromkeys(concept for option_list in option_lists for concept in option_list))
+
+    tournament = Tournament(concepts, option_lists)
+    generated_answers = [None] * len(ids)
+
+    while not tournament.is_finished():
+
+        brackets = tournament.create_brackets(t, rng)
+        choices = np.zeros(brackets.shape[:2], dtype=np.int64)
+
+        rows = [(j, i) for i in range(brackets.shape[1]) for j in range(len(ids))]
+        step = rows_per_forward if rows_per_forward else len(ids)
+
+        for start in range(0, len(rows), step):
+
+            packed_rows = rows[start:start+step]
+            index = torch.tensor([j for j, _ in packed_rows], device=image_embeds.device)
+
+            bracket_lists = [tournament.names(brackets[j, i]) for j, i in packed_rows]
+            questions = [create_multiple_choice_question(template, options_list=bracket_list)
+                            for bracket_list in bracket_lists]
+
+            outputs = ask(model, None, questions, bracket_lists, inference_method,
+                          image_embeds=image_embeds.index_select(0, index))
+
+            for (j, i), answer in zip(packed_rows, outputs):
+                choices[j, i] = postprocess(answer)
+                generated_answers[j] = answer
+
+        tournament.select_winners(brackets, choices)
+
+    if not tournament.levels: return
+
+    for j, (id, winners) in enumerate(zip(ids, tournament.winners())):
+        options[id]["concepts"] = winners
+        options[id].setdefault("option_list", {})
+
+        for k, bracket_lists in enumerate(tournament.option_lists(j)):
+            options[id]["option_list"][level + k + 1] = [
+                create_multiple_choice_question(template, options_list=bracket_list).split("Options:")[-1]
+                    for bracket_list in bracket_lists
+            ]
+
+        options[id]["generated_answer"] = generated_answers[j]
+        options[id]["reference_answer"] = reference_answers[j]
+
+def restore_options(log, options):
+    """
+        Restore the tournament results of the figures in the result log
 
         Returns:
-            Winner of the tournament classification approach
+            Set of the figure ids with a finished tournament
     """
-    level += 1
-    print(f"Level: {level}")
-    
-    last_key = list(options.keys())[-1]
-    
-    if len(options[last_key]["concepts"]) == 1: # last sample has 1 option
-        return options
-    else:
-        if len(options[last_key]["concepts"]) >= t:
+    done = set()
 
-            for id, option_list in options.items():
+    for record in log.read():
+        state = record["options"]
+        state["option_list"] = {int(k): v for k, v in state.get("option_list", {}).items()}
 
-                option_list = option_list["concepts"]
+        options[record["id"]] = state
+        done.add(record["id"])
 
-                if isinstance(option_list, str):
-                    option_list = list(option_list)
-                
-                random.shuffle(option_list)
+    return done
+
+def classify(model, loader, template, options, t, level=0, inference_method="generate", log=None,
+             rows_per_forward=None):
+    """
+        Classify the figures using multiple-choice tournament classification approach
 
-                options[id]["concepts"] = [
-                    option_list[i:i+t] for i in range(0, len(option_list), t)]
-        else:
-            for id, option_list in options.items():
-                
-                options_list = options[id]["concepts"]
-                random.shuffle(options_list)
+        The loader is iterated once: each batch of figures is encoded once with
+        the vision encoder and all levels of its tournament are played before
+        moving on to the next batch
+
+        Args:
+            model: LVLM to use for classification
+            loader: figures to classify
+            template: multiple-choice classification template to use for classification
+            options: all possible classification labels
+            t: number of options to use
+            level: round of tournament to start from
+            inference_method: "generate" or "likelihood", see ask
+            log: ResultLog to persist the finished tournaments to; figures
+                already in the log are not classified again
+            rows_per_forward: maximum number of (figure, bracket) rows per forward
+
+        Returns:
+            Winner of the tournament classification approach
+    """
+    done = restore_options(log, options) if log is not None else set()
 
-                options[id]["concepts"] = [options_list]
+    rng = np.random.default_rng(random.getrandbits(64))
 
-        for i in range(len(options[last_key]["concepts"])):
-            
-            for batch in loader:
+    for batch in tqdm(loader):
 
-                ids = batch[0]
-                figures = batch[1]
-                reference_answers = batch[2]
+        ids = batch[0]
+        figures = batch[1]
+        reference_answers = batch[2]
 
-                questions = [
-                    create_multiple_choice_question(template, options_list=options[id]["concepts"][i])
-                        for id in ids
-                ]
+        keep = [j for j, id in enumerate(ids) if id not in done]
+        if not keep: continue
 
-                outputs, _ = generate(model, figures, questions)
+        if len(keep) < len(ids):
+            ids = [ids[j] for j in keep]
+            figures = figures[keep]
+            reference_answers = [reference_answers[j] for j in keep]
 
-                for id, answer, question, reference_answer in zip(ids, outputs, questions, reference_answers):
-                    try:
-                        intermediate_answer = options[id]["concepts"][i][postprocess(answer)-1]
-                    except IndexError:
-                        intermediate_answer = "None"
+        image_embeds = encode_images(model, figures)
 
-                    options[id].setdefault("option_list", {})
-                    options[id]["option_list"].setdefault(level, [])
-                    options[id]["option_list"][level].append(question.split("Options:")[-1])
+        play_tournament(model, image_embeds, ids, reference_answers, template, options, t, rng, level,
+                        inference_method, rows_per_forward)
 
-                    options[id]["concepts"][i] = intermediate_answer
-                    options[id]["generated_answer"] = answer
-                    options[id]["reference_answer"] = reference_answer
+        if log is not None:
+            log.append([{"id": id, "options": options[id]} for id in ids])
 
-        return classify(model, loader, template, options, t, level)
+    return options
 
 def get_top_k(answers, k):
     """Select the top-k classification label"""
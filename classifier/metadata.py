@@ -10,16 +10,22 @@ batch_size = config["batch_size"]
 
 _ASPECTS = ["type", "uspc", "object", "projection"]
 
-concepts = {
-    aspect: list(load_json(f"{config['cls_dataset_path']}/{aspect}/concepts.json")["concepts"])
-    for aspect in _ASPECTS
-}
+concepts = {}
+
+def get_concepts(aspect):
+    """
+        Return the classification labels of the aspect, read on first use
+    """
+    if aspect not in concepts:
+        concepts[aspect] = list(load_json(f"{config['cls_dataset_path']}/{aspect}/concepts.json")["concepts"])
+
+    return concepts[aspect]
 
 def get_template(classifier, aspect):
     """
         Return 
     """
-    if classifier == "bc":
+    if classifier in ["bc", "hbc"]:
         SELECTED_TEMPLATES_IDS = {
             "type": "T110",
             "projection": "T120",
@@ -43,20 +49,29 @@ def get_template(classifier, aspect):
     
     return templates[SELECTED_TEMPLATES_IDS[aspect]]
 
-def get_options(aspect, loader):
+def get_options(aspect, ids):
+    """
+        Return the classification labels to use for each figure, in a random
+        order per figure
+
+        Args:
+            aspect: aspect to classify for
+            ids: figure ids, e.g. from dataset.get_ids
 
+        Returns:
+            Dictionary of figure id to classification labels
+    """
     options_dict = {}
 
-    for batch in loader:
+    for id in ids:
 
-        for id in batch[0]:
-            
-            options = concepts[aspect]
-            random.shuffle(options)
+        # a fresh copy per figure, so the options only depend on the random seed
+        options = list(get_concepts(aspect))
+        random.shuffle(options)
 
-            options_dict[id] = {
-                "concepts": options
-            }
+        options_dict[id] = {
+            "concepts": options
+        }
 
     return options_dict
 
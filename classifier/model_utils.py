@@ -1,21 +1,14 @@
 import os
-import yaml
-import random
+import gc
+import functools
+import collections
 
 import torch
 
-from omegaconf import OmegaConf
-
-from lavis.common.registry import registry
-from lavis.models import load_model, load_preprocess
+from profiling import timer, profiled
 
 os.environ['TOKENIZERS_PARALLELISM'] = 'false'
 
-config = yaml.safe_load(open("config.yaml"))
-
-random.seed(config["seed"])
-torch.manual_seed(config["seed"])
-
 device = torch.device("cuda") if torch.cuda.is_available() else "cpu"
 
 def get_model_and_preprocess(model_dir=None):
@@ -30,6 +23,11 @@ def get_model_and_preprocess(model_dir=None):
         Returns:
             Model class and visual preprocessing function (eval)
     """
+    # LAVIS is imported on first use, it is slow to import
+    from omegaconf import OmegaConf
+
+    from lavis.common.registry import registry
+    from lavis.models import load_model, load_preprocess
 
     name = "blip2_t5_instruct"
     model_type = "flant5xl"
@@ -64,6 +62,133 @@ def get_model_and_preprocess(model_dir=None):
 
     return model.to(device), vis_preprocess["eval"]
 
+def cpu_supports_bf16():
+    """Return True if the CPU has native bfloat16 support (oneDNN)"""
+    # private PyTorch op, assume no support if it is missing or fails
+    try:
+        return bool(torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except Exception:
+        return False
+
+def optimize_for_cpu(model, quantize=True, bf16_vision=True, num_threads=None):
+    """
+        Prepare an LVLM for CPU inference
+
+        The T5 linear layers are quantized to int8 with dynamic quantization
+        (weights stored as int8, activations quantized on the fly) and the
+        vision encoder runs under bfloat16 autocast if the CPU supports it.
+        With bf16_vision the default generate path encodes the figures with
+        encode_images, since LAVIS does not autocast on CPU
+
+        Args:
+            model: LVLM model loaded on CPU
+            quantize: quantize the T5 linear layers to int8
+            bf16_vision: run the vision encoder in bfloat16 where supported
+            num_threads: number of intra-op threads (optional)
+
+        Returns:
+            CPU optimized model
+    """
+    if model is None: return model
+
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    if quantize:
+        model.t5_model = torch.ao.quantization.quantize_dynamic(
+            model.t5_model.float(), {torch.nn.Linear}, dtype=torch.qint8
+        )
+
+    model.vision_bf16 = bf16_vision and cpu_supports_bf16()
+
+    return model
+
+def get_model_size(model):
+    """
+        Return the size of the model parameters, buffers and packed int8
+        weights of dynamically quantized layers in bytes
+    """
+    if model is None: return 0
+
+    # the packed weights are neither parameters nor buffers, but are in the
+    # state dict as (weight, bias) tuples; tied parameters are counted once
+    tensors = {}
+
+    def add(value):
+        if isinstance(value, torch.Tensor):
+            tensors[id(value)] = value
+        elif isinstance(value, (tuple, list)):
+            for item in value: add(item)
+
+    for value in model.state_dict(keep_vars=True).values():
+        add(value)
+
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        add(tensor)
+
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors.values())
+
+class ModelPool:
+    """
+        Cache of loaded LVLMs keyed by model output directory
+
+        Models are evicted in least-recently-used order when the cached models
+        exceed the memory budget. Without a GPU the loaded models are prepared
+        with optimize_for_cpu(**cpu_options)
+    """
+    def __init__(self, budget_gb, cpu_options=None):
+        self.budget = budget_gb * 1024**3
+        self.cpu_options = cpu_options or {}
+        self.models = collections.OrderedDict()
+
+    def size(self):
+        return sum(size for _, _, size in self.models.values())
+
+    def evict(self, required=0):
+        """Evict least recently used models until required bytes fit in the budget"""
+        while self.models and self.size() + required > self.budget:
+            model_dir, _ = self.models.popitem(last=False)
+            print(f"Evicting {model_dir}")
+
+        gc.collect()
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def get(self, model_dir=None):
+        """
+            Return the model and preprocess function for the model directory,
+            loading it with get_model_and_preprocess if it is not cached
+
+            Args:
+                model_dir: path to model output directory
+
+            Returns:
+                Model class and visual preprocessing function (eval)
+        """
+        if model_dir in self.models:
+            self.models.move_to_end(model_dir)
+            model, vis_preprocess, _ = self.models[model_dir]
+            return model, vis_preprocess
+
+        # All cached models share the same architecture
+        estimate = max([size for _, _, size in self.models.values()], default=0)
+        self.evict(required=estimate)
+
+        model, vis_preprocess = get_model_and_preprocess(model_dir)
+        if device == "cpu":
+            model = optimize_for_cpu(model, **self.cpu_options)
+
+        # the estimate may be off (first model, CPU quantization), evict on the loaded size
+        self.models[model_dir] = (model, vis_preprocess, get_model_size(model))
+        self.evict()
+
+        if model_dir not in self.models:
+            print(f"Model {model_dir} exceeds the model pool budget")
+
+        return model, vis_preprocess
+
+@profiled("postprocess")
 def postprocess(output): 
     """
         Postprocess LVLM output text
@@ -90,7 +215,122 @@ def postprocess(output):
     
     return output
 
-def generate(model, figures, questions):
+@profiled("encode_images")
+def encode_images(model, figures):
+    """
+        Encode the figures with the vision encoder of the LVLM
+
+        The vision encoder output does not depend on the prompt, so it can be
+        computed once per figure and reused for every question about it
+
+        Args:
+            model: LVLM model to use
+            figures: batch of preprocessed images
+
+        Returns:
+            Image embeddings (ViT output) of the figures
+    """
+    if getattr(model, "vision_bf16", False):
+        with torch.no_grad(), torch.autocast("cpu", dtype=torch.bfloat16):
+            image_embeds = model.ln_vision(model.visual_encoder(figures.to(device).float()))
+
+        return image_embeds.float()
+
+    with torch.no_grad(), model.maybe_autocast():
+        image_embeds = model.ln_vision(model.visual_encoder(figures.to(device).float()))
+
+    return image_embeds
+
+@functools.lru_cache(maxsize=2**16)
+def tokenize_prompt(tokenizer, prompt, max_length=None):
+    """Return the token ids of a prompt, tokenized once per (tokenizer, prompt)"""
+    return tuple(tokenizer(prompt, truncation=max_length is not None, max_length=max_length).input_ids)
+
+def tokenize_prompts(tokenizer, prompts, device, max_length=None):
+    """
+        Tokenize a batch of prompts with right padding to the longest prompt
+
+        Same output as tokenizer(prompts, padding="longest"), but every distinct
+        prompt (e.g. the binary question of a concept, asked for every figure) is
+        only tokenized once, see tokenize_prompt
+
+        Args:
+            tokenizer: Q-Former or T5 tokenizer of the LVLM
+            prompts: list of prompts
+            device: device of the returned tensors
+            max_length: truncation length (optional)
+
+        Returns:
+            input_ids: padded token ids
+            attention_mask: attention mask of the token ids
+    """
+    token_ids = [tokenize_prompt(tokenizer, prompt, max_length) for prompt in prompts]
+    length = max(len(ids) for ids in token_ids)
+
+    input_ids = torch.tensor([ids + (tokenizer.pad_token_id,) * (length - len(ids)) for ids in token_ids],
+                             dtype=torch.long)
+    attention_mask = torch.tensor([[1] * len(ids) + [0] * (length - len(ids)) for ids in token_ids],
+                                  dtype=torch.long)
+
+    return input_ids.to(device), attention_mask.to(device)
+
+def prepare_inputs(model, image_embeds, prompts):
+    """
+        Build the T5 encoder inputs from image embeddings and prompts
+
+        The Q-Former of InstructBLIP is instruction-aware, so the query
+        embeddings are recomputed for every prompt. The Q-Former and the T5
+        encoder attend bidirectionally and the prompt follows the image query
+        embeddings, so no encoder state of a shared prompt prefix is reusable;
+        only the tokenization of the prompts is cached, see tokenize_prompts
+
+        Args:
+            model: LVLM model to use
+            image_embeds: image embeddings from encode_images, one row per prompt
+            prompts: list of prompts
+
+        Returns:
+            inputs_embeds: T5 encoder input embeddings
+            encoder_atts: T5 encoder attention mask
+    """
+    image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image_embeds.device)
+    query_tokens = model.query_tokens.expand(image_embeds.size(0), -1, -1)
+
+    if model.qformer_text_input:
+        qformer_ids, qformer_mask = tokenize_prompts(model.tokenizer, prompts, image_embeds.device,
+                                                     max_length=model.max_txt_len)
+        query_atts = torch.ones(query_tokens.size()[:-1], dtype=torch.long).to(image_embeds.device)
+        Qformer_atts = torch.cat([query_atts, qformer_mask], dim=1)
+
+        query_output = model.Qformer.bert(
+            qformer_ids,
+            attention_mask=Qformer_atts,
+            query_embeds=query_tokens,
+            encoder_hidden_states=image_embeds,
+            encoder_attention_mask=image_atts,
+            return_dict=True,
+        )
+    else:
+        query_output = model.Qformer.bert(
+            query_embeds=query_tokens,
+            encoder_hidden_states=image_embeds,
+            encoder_attention_mask=image_atts,
+            return_dict=True,
+        )
+
+    inputs_t5 = model.t5_proj(query_output.last_hidden_state[:, :query_tokens.size(1), :])
+    atts_t5 = torch.ones(inputs_t5.size()[:-1], dtype=torch.long).to(image_embeds.device)
+
+    input_ids, input_mask = tokenize_prompts(model.t5_tokenizer, prompts, image_embeds.device)
+    encoder_atts = torch.cat([atts_t5, input_mask], dim=1)
+
+    with model.maybe_autocast(dtype=torch.bfloat16):
+        inputs_embeds = model.t5_model.encoder.embed_tokens(input_ids)
+        inputs_embeds = torch.cat([inputs_t5, inputs_embeds], dim=1)
+
+    return inputs_embeds, encoder_atts
+
+def generate(model, figures, questions, image_embeds=None):
     """
         Function to query the LVLM with an input prompt and image
 
@@ -98,23 +338,193 @@ def generate(model, figures, questions):
             model: LVLM model to query to
             figures: List of images to use in query input
             questions: List of questions to use in query input
+            image_embeds: cached image embeddings of the figures (optional),
+                when given the vision encoder is skipped
         
         Returns:
             answers: uuptut text generated by the model (LVLM)
             scores: text probability score from the model
     """
-    samples = {
-        "image": figures.to(device),
-        "text_input": [f"Question: {q} Answer: " for q in questions],
-    }
-
-    answers, scores = model.predict_answers(
-            samples=samples,
-            inference_method="generate",
-            num_beams=5,
-            max_len=10,
-            min_len=1,
-            prompt='',
+    # encode_images is timed as its own stage
+    if image_embeds is None and getattr(model, "vision_bf16", False):
+        image_embeds = encode_images(model, figures)
+
+    with timer("generate", count=len(questions)):
+        if image_embeds is not None:
+            return generate_from_embeddings(model, image_embeds, questions)
+
+        samples = {
+            "image": figures.to(device).float(),
+            "text_input": [f"Question: {q} Answer: " for q in questions],
+        }
+
+        answers, scores = model.predict_answers(
+                samples=samples,
+                inference_method="generate",
+                num_beams=5,
+                max_len=10,
+                min_len=1,
+                prompt='',
+            )
+
+    return answers, scores
+
+def generate_from_embeddings(model, image_embeds, questions):
+    """
+        Query the LVLM with input prompts and cached image embeddings
+
+        Same decoding settings as generate, but only the text side
+        (Q-Former and T5) is run
+
+        Args:
+            model: LVLM model to query to
+            image_embeds: image embeddings from encode_images, one row per question
+            questions: List of questions to use in query input
+
+        Returns:
+            answers: output text generated by the model (LVLM)
+            scores: beam score (length-normalised log-probability) of the answers
+    """
+    prompts = [f"Question: {q} Answer: " for q in questions]
+
+    with torch.no_grad():
+        inputs_embeds, encoder_atts = prepare_inputs(model, image_embeds, prompts)
+
+        with model.maybe_autocast(dtype=torch.bfloat16):
+            outputs = model.t5_model.generate(
+                inputs_embeds=inputs_embeds,
+                attention_mask=encoder_atts,
+                num_beams=5,
+                max_new_tokens=10,
+                min_length=1,
+                length_penalty=-1,
+                return_dict_in_generate=True,
+                output_scores=True,
+            )
+
+    answers = model.t5_tokenizer.batch_decode(outputs.sequences, skip_special_tokens=True)
+    scores = outputs.sequences_scores.tolist()
+
+    return answers, scores
+
+@functools.lru_cache(maxsize=None)
+def get_candidate_token_ids(tokenizer, candidates):
+    """
+        Return the T5 token ids of each candidate answer
+
+        Args:
+            tokenizer: T5 tokenizer of the LVLM
+            candidates: tuple of candidate answers
+
+        Returns:
+            List of token id sequences, one per candidate
+    """
+    return [tuple(tokenizer(candidate, add_special_tokens=False).input_ids) for candidate in candidates]
+
+def score_sequences(model, inputs_embeds, encoder_atts, sequences):
+    """
+        Return the log-likelihood of each token sequence as the answer to each prompt
+
+        The T5 encoder runs once; the decoder is teacher-forced on each
+        sequence for all prompts
+
+        Args:
+            model: LVLM model to query to
+            inputs_embeds: T5 encoder input embeddings of the prompts
+            encoder_atts: T5 encoder attention mask
+            sequences: token id sequences of the candidates
+
+        Returns:
+            Tensor of prompts x sequences log-likelihoods
+    """
+    with model.maybe_autocast(dtype=torch.bfloat16):
+        encoder_outputs = model.t5_model.encoder(
+            inputs_embeds=inputs_embeds,
+            attention_mask=encoder_atts,
+            return_dict=True,
         )
 
+    start_token_id = model.t5_model.config.decoder_start_token_id
+    scores = []
+
+    for sequence in sequences:
+        targets = torch.tensor(sequence, dtype=torch.long, device=inputs_embeds.device)
+        decoder_input_ids = torch.cat([targets.new_tensor([start_token_id]), targets[:-1]])
+
+        with model.maybe_autocast(dtype=torch.bfloat16):
+            outputs = model.t5_model(
+                encoder_outputs=encoder_outputs,
+                attention_mask=encoder_atts,
+                decoder_input_ids=decoder_input_ids.expand(inputs_embeds.size(0), -1),
+                return_dict=True,
+            )
+
+        log_probabilities = outputs.logits.float().log_softmax(dim=-1)
+        scores.append(log_probabilities[:, torch.arange(len(sequence), device=targets.device), targets].sum(dim=-1))
+
+    return torch.stack(scores, dim=1)
+
+def score_answers(model, figures, questions, candidates, image_embeds=None, num_candidates=None):
+    """
+        Score candidate answers by their likelihood
+
+        Used for questions with a closed answer set, e.g. 'yes'/'no' for binary
+        questions or the option numbers for multiple-choice questions. When the
+        candidates start with distinct tokens, they are scored by their first
+        token in a single decoder step; otherwise (e.g. '1' and '10' starting
+        with the same token) by the likelihood of their full token sequences
+
+        Args:
+            model: LVLM model to query to
+            figures: List of images to use in query input
+            questions: List of questions to use in query input
+            candidates: List of candidate answers shared by all questions
+            image_embeds: cached image embeddings of the figures (optional)
+            num_candidates: number of valid candidates per question (optional),
+                candidates after that are ignored for the question
+
+        Returns:
+            answers: most likely candidate for each question
+            scores: normalised probability of each candidate for each question
+    """
+    sequences = get_candidate_token_ids(model.t5_tokenizer, tuple(candidates))
+    first_token_ids = [sequence[0] for sequence in sequences]
+    prompts = [f"Question: {q} Answer: " for q in questions]
+
+    if image_embeds is None:
+        image_embeds = encode_images(model, figures)
+
+    with torch.no_grad(), timer("score_answers", count=len(questions)):
+        inputs_embeds, encoder_atts = prepare_inputs(model, image_embeds, prompts)
+
+        if len(set(first_token_ids)) == len(first_token_ids):
+            decoder_input_ids = torch.full(
+                (len(prompts), 1),
+                model.t5_model.config.decoder_start_token_id,
+                dtype=torch.long,
+                device=inputs_embeds.device
+            )
+
+            with model.maybe_autocast(dtype=torch.bfloat16):
+                outputs = model.t5_model(
+                    inputs_embeds=inputs_embeds,
+                    attention_mask=encoder_atts,
+                    decoder_input_ids=decoder_input_ids,
+                    return_dict=True,
+                )
+
+            logits = outputs.logits[:, 0, first_token_ids].float()
+        else:
+            logits = score_sequences(model, inputs_embeds, encoder_atts, sequences)
+
+        if num_candidates is not None:
+            positions = torch.arange(len(candidates), device=logits.device)
+            limits = torch.tensor(num_candidates, device=logits.device).unsqueeze(1)
+            logits = logits.masked_fill(positions.unsqueeze(0) >= limits, float("-inf"))
+
+        probabilities = logits.softmax(dim=-1)
+
+        answers = [candidates[i] for i in probabilities.argmax(dim=-1).tolist()]
+        scores = probabilities.tolist()
+
     return answers, scores
\ No newline at end of file
@@ -1,39 +1,72 @@
 import json
+import hashlib
+
 import torch
 import torch.nn as nn
 import numpy as np
 
 from tqdm import tqdm
 
-from sklearn.metrics.pairwise import cosine_similarity
-
-from sentence_transformers import SentenceTransformer, models
-
 from model_utils import generate
+from answer_cache import normalize_answer
 from common_utils import get_config
+from profiling import profiled, timer
 
 config = get_config()
 
-ASPECTS = config["aspects"]
-
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
-## Load PatentBERT ##
-bert_embedding_model = models.Transformer('anferico/bert-for-patents', max_seq_length=128)
-pooling_model = models.Pooling(bert_embedding_model.get_word_embedding_dimension())
-dense_model = models.Dense(in_features=pooling_model.get_sentence_embedding_dimension(),
-                            out_features=256, activation_function=nn.Tanh())
-model = SentenceTransformer(modules=[bert_embedding_model, pooling_model, dense_model])
-model.to(device)
-model.eval()
-
 batch_size = 512
 
+# PatentBERT and the concept embeddings are created on first use
+_embedding_model = None
+_concept_index = {}
+
+def get_embedding_model():
+    """
+        Return the PatentBERT sentence embedding model, loaded on first use
+
+        The dense projection is initialised with the config seed so that the
+        embeddings (and the embedding model id) are the same across runs
+    """
+    global _embedding_model
+
+    if _embedding_model is None:
+        from sentence_transformers import SentenceTransformer, models
+
+        bert_embedding_model = models.Transformer('anferico/bert-for-patents', max_seq_length=128)
+        pooling_model = models.Pooling(bert_embedding_model.get_word_embedding_dimension())
+
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(config["seed"])
+            dense_model = models.Dense(in_features=pooling_model.get_sentence_embedding_dimension(),
+                                        out_features=256, activation_function=nn.Tanh())
+
+        model = SentenceTransformer(modules=[bert_embedding_model, pooling_model, dense_model])
+        model.to(device)
+        model.eval()
+
+        _embedding_model = model
+
+    return _embedding_model
+
+def get_embedding_model_id():
+    """
+        Return an id of the PatentBERT embedding model
+
+        The id includes a hash of the dense projection weights, which are not
+        part of the pre-trained checkpoint
+    """
+    dense_model = get_embedding_model()[2]
+    weights = dense_model.linear.weight.detach().cpu().numpy().tobytes()
+    return f"anferico/bert-for-patents/{hashlib.sha1(weights).hexdigest()[:12]}"
+
 def get_patent_bert_embeddings(concepts):
     """Get PatentBERT embeddings for the list of concepts"""
     with torch.inference_mode():
-        features = model.encode(concepts, batch_size=512, convert_to_numpy=True, normalize_embeddings=True,
-                                show_progress_bar=False, device=device)
+        features = get_embedding_model().encode(concepts, batch_size=512, convert_to_numpy=True,
+                                                normalize_embeddings=True, show_progress_bar=False,
+                                                device=device)
         return features
 
 def load_concepts(aspect):
@@ -45,23 +78,85 @@ def load_concepts(aspect):
     
     return concepts
 
-concepts_dict = {
-    aspect: load_concepts(aspect) for aspect in ASPECTS
-}
+class ConceptIndex:
+    """
+        Matrix of normalised PatentBERT embeddings of the concepts of an aspect
+
+        Row i of the matrix is the embedding of concepts[i]
+    """
+    def __init__(self, concepts):
+        self.concepts = list(concepts)
+        self.matrix = get_patent_bert_embeddings(self.concepts)
+        self.fingerprint = hashlib.sha1("\n".join(self.concepts).encode("utf-8")).hexdigest()[:12]
+
+    def search(self, queries, k=1):
+        """
+            Find the most similar concepts for normalised query embeddings
+
+            Args:
+                queries: normalised query embeddings (one row per query)
+                k: number of concepts to return per query
+
+            Returns:
+                List of the top-k concepts for each query, most similar first
+        """
+        scores = queries @ self.matrix.T
+
+        if k == 1:
+            top_k = scores.argmax(axis=1)[:, None]
+        else:
+            top_k = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+
+        return [[self.concepts[j] for j in row] for row in top_k]
+
+def get_concept_index(aspect):
+    """Return the ConceptIndex of the aspect, built on first use"""
+    if aspect not in _concept_index:
+        _concept_index[aspect] = ConceptIndex(load_concepts(aspect))
 
-embeddings_dict = {
-    aspect: {
-        concept: embedding
-        for concept, embedding in zip(
-            concepts_dict[aspect], get_patent_bert_embeddings(concepts_dict[aspect]))
-    } for aspect in ASPECTS
-}
+    return _concept_index[aspect]
 
 def create_open_ended_question(template):
     """Create open ended question from a template"""
     question = template["question"]
     return question
 
+@profiled("find_closest_concepts")
+def find_closest_concepts(answers, aspect, k=1, cache=None):
+    """
+        Find the closest concepts from the concepts dict to a batch of answers
+
+        The distinct answers are encoded in one batch and compared to all
+        concepts of the aspect with a single matrix product. With a cache, only
+        answers not seen before are encoded
+
+        Args:
+            answers: answer texts generated by an LVLM for an open-ended question
+            aspect: aspect to classifiy to
+            k: number of concepts to return per answer
+            cache: AnswerCache to memoize the answer to concept mapping (k = 1 only)
+
+        Returns:
+            most similar concept for each answer (list of top-k concepts if k > 1)
+    """
+    index = get_concept_index(aspect)
+    texts = [normalize_answer(answer) for answer in answers]
+
+    use_cache = cache is not None and k == 1
+    known = cache.get_many(aspect, index.fingerprint, texts) if use_cache else {}
+    known = {text: [concept] for text, concept in known.items()}
+
+    unseen = list(dict.fromkeys(text for text in texts if text not in known))
+
+    if unseen:
+        top_k = index.search(get_patent_bert_embeddings(unseen), k)
+        known.update(zip(unseen, top_k))
+
+        if use_cache:
+            cache.put_many(aspect, index.fingerprint, {text: known[text][0] for text in unseen})
+
+    return [known[text][0] for text in texts] if k == 1 else [known[text] for text in texts]
+
 def find_closest_concept(answer, aspect):
     """
         Find the closest concept from the concepts dict to the answer
@@ -73,15 +168,9 @@ def find_closest_concept(answer, aspect):
         Returns:
             most similar concept to the answer
     """
-    embeddings = embeddings_dict[aspect]
-    query_vector = model.encode(answer, convert_to_tensor=True, device=device,
-                                    normalize_embeddings=True, show_progress_bar=False).cpu().numpy()
-    index = np.array([v for _, v in embeddings.items()])
-    
-    scores = cosine_similarity(query_vector.reshape(1, -1), index).flatten()
-    return list(embeddings.keys())[np.argmax(scores)]
+    return find_closest_concepts([answer], aspect)[0]
 
-def classify(model, loader, template, aspect):
+def classify(model, loader, template, aspect, cache=None, log=None):
     """
         Classify the figures using open-ended classification approach
 
@@ -90,12 +179,23 @@ def classify(model, loader, template, aspect):
             loader: figures to classify
             template: open-ended classification template to use for classification
             aspect: aspect to classify for
+            cache: AnswerCache to memoize the answer to concept mapping (optional)
+            log: ResultLog to persist the answers to; figures already in the
+                log are not classified again
 
         Returns:
             List of classification labels for the figures
     """
     answers = {}
 
+    if log is not None:
+        for record in log.read():
+            answers.setdefault(record["id"], {
+                "reference_answer": record["reference_answer"],
+                "generated_answer": record["generated_answer"],
+                "selected_answer": record["selected_answer"]
+            })
+
     for batch in tqdm(loader):
 
         ids = batch[0]
@@ -103,16 +203,157 @@ def classify(model, loader, template, aspect):
         figures = batch[1]
         reference_answers = batch[2]
 
+        if answers:
+            keep = [j for j, id in enumerate(ids) if id not in answers]
+            if not keep: continue
+
+            ids = [ids[j] for j in keep]
+            figures = figures[keep]
+            reference_answers = [reference_answers[j] for j in keep]
+
         questions = [create_open_ended_question(template) for _ in ids]
         outputs, _ = generate(model, figures, questions)
+        selected_answers = find_closest_concepts(outputs, aspect, cache=cache)
+
+        if log is not None:
+            log.append([
+                {"id": id, "reference_answer": reference_answer, "generated_answer": answer,
+                 "selected_answer": selected_answer}
+                for id, answer, selected_answer, reference_answer
+                    in zip(ids, outputs, selected_answers, reference_answers)
+            ])
+
+        for id, answer, selected_answer, reference_answer in zip(ids, outputs, selected_answers, reference_answers):
+            answers.setdefault(id, {
+                "reference_answer": reference_answer,
+                "generated_answer": answer,
+                "selected_answer": selected_answer
+            })
+
+    return answers
+
+def classify_served(model, loader, template, aspect, max_batch_size=128, max_wait=0.01, cache=None, log=None):
+    """
+        Classify the figures using open-ended classification approach through
+        an InferenceServer
+
+        Every figure is submitted as a separate request; the server coalesces
+        the requests into batches, so loading the next figures and mapping the
+        answers to concepts overlap with the LVLM computing the current batch.
+        The AnswerCache is only used on the event loop thread (SQLite
+        connections are bound to their thread); the answers not in the cache
+        are embedded and matched on a single dedicated thread
+
+        Args:
+            model: LVLM to use for classification
+            loader: figures to classify
+            template: open-ended classification template to use for classification
+            aspect: aspect to classify for
+            max_batch_size: maximum number of requests per LVLM forward
+            max_wait: maximum time in seconds to wait for a batch to fill
+            cache: AnswerCache to memoize the answer to concept mapping (optional)
+            log: ResultLog to persist the answers to, see classify
+
+        Returns:
+            List of classification labels for the figures
+    """
+    import asyncio
 
-        for id, answer, reference_answer in zip(ids, outputs, reference_answers):
+    from concurrent.futures import ThreadPoolExecutor
+
+    from inference_server import InferenceServer
+
+    answers = {}
+    index = get_concept_index(aspect)
+    matcher = ThreadPoolExecutor(max_workers=1)
+
+    def match(texts):
+        with timer("find_closest_concepts"):
+            return [concepts[0] for concepts in index.search(get_patent_bert_embeddings(texts), 1)]
+
+    if log is not None:
+        for record in log.read():
+            answers.setdefault(record["id"], {
+                "reference_answer": record["reference_answer"],
+                "generated_answer": record["generated_answer"],
+                "selected_answer": record["selected_answer"]
+            })
+
+    async def classify_batch(server, ids, figures, reference_answers):
+        question = create_open_ended_question(template)
+        results = await asyncio.gather(*[server.submit(figure, question) for figure in figures])
+        outputs = [answer for answer, _ in results]
+
+        texts = [normalize_answer(answer) for answer in outputs]
+        known = cache.get_many(aspect, index.fingerprint, texts) if cache is not None else {}
+        unseen = list(dict.fromkeys(text for text in texts if text not in known))
+
+        if unseen:
+            loop = asyncio.get_running_loop()
+            matches = dict(zip(unseen, await loop.run_in_executor(matcher, match, unseen)))
+            known.update(matches)
+
+            if cache is not None:
+                cache.put_many(aspect, index.fingerprint, matches)
+
+        selected_answers = [known[text] for text in texts]
+
+        if log is not None:
+            log.append([
+                {"id": id, "reference_answer": reference_answer, "generated_answer": answer,
+                 "selected_answer": selected_answer}
+                for id, answer, selected_answer, reference_answer
+                    in zip(ids, outputs, selected_answers, reference_answers)
+            ])
+
+        for id, answer, selected_answer, reference_answer in zip(ids, outputs, selected_answers, reference_answers):
             answers.setdefault(id, {
                 "reference_answer": reference_answer,
                 "generated_answer": answer,
-                "selected_answer": find_closest_concept(answer, aspect)
+                "selected_answer": selected_answer
             })
 
+    async def run():
+        loop = asyncio.get_running_loop()
+        batches = iter(tqdm(loader))
+        tasks = []
+
+        async with InferenceServer(model, max_batch_size, max_wait) as server:
+
+            while True:
+                batch = await loop.run_in_executor(None, next, batches, None)
+                if batch is None: break
+
+                ids = batch[0]
+                ids = [id.item() if not isinstance(id, str) else id for id in ids]
+                figures = batch[1]
+                reference_answers = batch[2]
+
+                keep = [j for j, id in enumerate(ids) if id not in answers]
+                if not keep: continue
+
+                tasks.append(asyncio.create_task(classify_batch(
+                    server,
+                    [ids[j] for j in keep],
+                    figures[keep],
+                    [reference_answers[j] for j in keep]
+                )))
+
+                # bound the number of loaded batches waiting for the LVLM
+                for task in tasks:
+                    if task.done(): task.result()
+
+                tasks = [task for task in tasks if not task.done()]
+                if len(tasks) > 2:
+                    await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+
+            await asyncio.gather(*tasks)
+
+    try:
+        asyncio.run(run())
+    finally:
+        matcher.shutdown()
+
     return answers
 
 def compute_accuracy(answers):
@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import functools
+import threading
+import contextlib
+import collections
+
+# Profiling is disabled by default: timer and count do nothing until enable is called.
+# Timers run in DataLoader worker processes (read, decode, preprocess) are only
+# recorded with num_workers: 0; with workers, the time the classifiers wait for
+# the next batch is recorded as dataloader_wait (see TimedIterable), which
+# includes them with num_workers: 0
+
+_profiler = None
+
+class Profiler:
+    """
+        Wall-clock timers and counters per pipeline stage
+
+        Every timed section adds its duration and a count to its stage; with
+        trace, every section is also recorded as a Chrome trace event
+        (chrome://tracing, https://ui.perfetto.dev)
+    """
+    def __init__(self, trace=False):
+        self.trace = trace
+        self.start = time.perf_counter()
+        self.times = collections.Counter()
+        self.counts = collections.Counter()
+        self.events = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def timer(self, stage, count=1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self.lock:
+                self.times[stage] += end - start
+                self.counts[stage] += count
+                if self.trace:
+                    self.events.append({
+                        "name": stage, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                        "ts": (start - self.start) * 1e6, "dur": (end - start) * 1e6,
+                        "args": {"count": count}
+                    })
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def summary(self):
+        """
+            Return the seconds and counts of each stage, and the other counters
+        """
+        return {
+            "seconds": time.perf_counter() - self.start,
+            "stages": {stage: {"seconds": self.times[stage], "count": self.counts[stage]}
+                            for stage in sorted(self.times)},
+            "counters": {name: self.counts[name] for name in sorted(self.counts) if name not in self.times}
+        }
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"Profile ({summary['seconds']:.2f}s)")
+        for stage, stats in summary["stages"].items():
+            print(f"  {stage}: {stats['seconds']:.2f}s ({stats['count']} calls)")
+        for name, count in summary["counters"].items():
+            print(f"  {name}: {count}")
+
+    def save_trace(self, file):
+        """Save the recorded events as Chrome trace JSON"""
+        with open(file, "w") as f: json.dump({"traceEvents": self.events}, f)
+
+def enable(trace=False):
+    """Start a new profile, return its Profiler"""
+    global _profiler
+    _profiler = Profiler(trace)
+    return _profiler
+
+def disable():
+    """Stop profiling, return the Profiler of the finished profile (None if disabled)"""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+def timer(stage, count=1):
+    """Context manager timing a section as the stage (no-op when disabled)"""
+    if _profiler is None: return contextlib.nullcontext()
+    return _profiler.timer(stage, count)
+
+def count(name, n=1):
+    """Increase a counter (no-op when disabled)"""
+    if _profiler is not None: _profiler.count(name, n)
+
+class TimedIterable:
+    """
+        Wrapper of an iterable (e.g. a DataLoader) timing every next() as the stage
+
+        Each iteration over the wrapper iterates the wrapped iterable again;
+        other attributes are forwarded to it
+    """
+    def __init__(self, iterable, stage):
+        self.iterable = iterable
+        self.stage = stage
+
+    def __iter__(self):
+        iterator = iter(self.iterable)
+        while True:
+            with timer(self.stage):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def __len__(self):
+        return len(self.iterable)
+
+    def __getattr__(self, name):
+        return getattr(self.iterable, name)
+
+def profiled(stage):
+    """Decorator timing every call of a function as the stage"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
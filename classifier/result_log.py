@@ -0,0 +1,70 @@
+import os
+import json
+
+class ResultLog:
+    """
+        Append-only JSONL log of the per-figure results of an experiment
+
+        Results are appended as soon as they are computed, so an interrupted
+        experiment can be resumed from the log instead of starting over
+    """
+    def __init__(self, path, resume=False):
+        """
+            Args:
+                path: JSONL file of the log
+                resume: keep the results of a previous run, otherwise the log
+                    is started from scratch
+        """
+        self.path = path
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        if not resume and os.path.isfile(path):
+            os.remove(path)
+
+        if resume and os.path.isfile(path):
+            self.truncate_partial_line()
+
+        self.file = open(path, "a")
+
+    def truncate_partial_line(self):
+        """Drop a partially written last line left by an interrupted run"""
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def read(self):
+        """
+            Return the logged results
+
+            Lines that cannot be decoded are skipped
+        """
+        records = []
+
+        if not os.path.isfile(self.path):
+            return records
+
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+
+        return records
+
+    def append(self, records):
+        """Append a list of results to the log"""
+        for record in records:
+            self.file.write(json.dumps(record) + "\n")
+
+        self.file.flush()
+
+    def close(self, remove=False):
+        """Close the log, removing the file if the experiment is complete"""
+        self.file.close()
+
+        if remove and os.path.isfile(self.path):
+            os.remove(self.path)
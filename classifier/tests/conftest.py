@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the classifier modules read config.yaml from the working directory
+CLASSIFIER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+os.chdir(CLASSIFIER_DIR)
+sys.path.insert(0, CLASSIFIER_DIR)
@@ -0,0 +1,34 @@
+import asyncio
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import inference_server
+
+from inference_server import InferenceServer
+
+def fake_generate(model, figures, questions):
+    return [f"answer {figure.sum().item():.0f}" for figure in figures], [1.0] * len(questions)
+
+def test_bad_request_fails_its_future_and_stop_returns(monkeypatch):
+    monkeypatch.setattr(inference_server, "generate", fake_generate)
+
+    async def run():
+        server = InferenceServer(None, max_batch_size=4, max_wait=0.05)
+        server.start()
+
+        good = asyncio.ensure_future(server.submit(torch.ones(3, 4, 4), "question"))
+        bad = asyncio.ensure_future(server.submit(torch.ones(3, 5, 5), "question"))
+
+        with pytest.raises(RuntimeError):
+            await bad
+        with pytest.raises(RuntimeError):
+            await good # batched with the bad request
+
+        # the server keeps serving after a failed batch
+        assert await server.submit(torch.ones(3, 4, 4), "question") == ("answer 48", 1.0)
+
+        await asyncio.wait_for(server.stop(), timeout=5)
+
+    asyncio.run(run())
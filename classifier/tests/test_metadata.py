@@ -0,0 +1,39 @@
+import random
+
+import metadata
+
+CONCEPTS = {
+    "object": [f"object {k:02d}" for k in range(20)],
+    "projection": [f"projection {k:02d}" for k in range(8)]
+}
+
+IDS = [f"F{i:010d}" for i in range(50)]
+
+def run_experiment(aspect, seed=1337):
+    """Options of an experiment as drawn by evaluate.run_experiment, copied when drawn"""
+    random.seed(seed)
+    return {id: tuple(options["concepts"]) for id, options in metadata.get_options(aspect, IDS).items()}
+
+def run_schedule(aspects):
+    return [(aspect, run_experiment(aspect)) for aspect in aspects]
+
+def test_options_do_not_depend_on_schedule_order(monkeypatch):
+    monkeypatch.setattr(metadata, "concepts", {aspect: list(concepts) for aspect, concepts in CONCEPTS.items()})
+    # e.g. bc/object, oc/projection, mc-ts/object
+    first = run_schedule(["object", "projection", "object"])
+
+    monkeypatch.setattr(metadata, "concepts", {aspect: list(concepts) for aspect, concepts in CONCEPTS.items()})
+    second = run_schedule(["projection", "object", "object"])
+
+    assert first[0][1] == first[2][1] == second[1][1] == second[2][1]
+    assert first[1][1] == second[0][1]
+
+def test_options_are_not_shared_between_figures(monkeypatch):
+    monkeypatch.setattr(metadata, "concepts", {"object": list(CONCEPTS["object"])})
+
+    random.seed(1337)
+    options = metadata.get_options("object", ["F1", "F2"])
+
+    assert options["F1"]["concepts"] is not options["F2"]["concepts"]
+    assert sorted(options["F1"]["concepts"]) == CONCEPTS["object"]
+    assert metadata.concepts["object"] == CONCEPTS["object"]
@@ -0,0 +1,47 @@
+import contextlib
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+import model_utils
+
+# multiple-choice option numbers of the largest option count (O20)
+CANDIDATES = tuple(str(i) for i in range(1, 21))
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    try:
+        return transformers.AutoTokenizer.from_pretrained("google/flan-t5-xl")
+    except OSError:
+        pytest.skip("T5 tokenizer not available")
+
+def test_candidate_token_ids_distinguish_option_numbers(tokenizer):
+    sequences = model_utils.get_candidate_token_ids(tokenizer, CANDIDATES)
+
+    assert len(set(sequences)) == len(CANDIDATES)
+    assert [tokenizer.decode(sequence).strip() for sequence in sequences] == list(CANDIDATES)
+
+def test_score_sequences_matches_teacher_forced_loss():
+    torch.manual_seed(0)
+    config = transformers.T5Config(vocab_size=32, d_model=16, d_kv=8, d_ff=32, num_layers=1, num_heads=2,
+                                   decoder_start_token_id=0, pad_token_id=0)
+
+    class TinyLVLM:
+        t5_model = transformers.T5ForConditionalGeneration(config).eval()
+        def maybe_autocast(self, dtype=None): return contextlib.nullcontext()
+
+    model = TinyLVLM()
+    inputs_embeds = torch.randn(3, 5, 16)
+    encoder_atts = torch.ones(3, 5, dtype=torch.long)
+    sequences = [(4,), (4, 7), (9, 7, 5)]
+
+    with torch.no_grad():
+        scores = model_utils.score_sequences(model, inputs_embeds, encoder_atts, sequences)
+
+        for j, sequence in enumerate(sequences):
+            labels = torch.tensor([sequence] * 3)
+            logits = model.t5_model(inputs_embeds=inputs_embeds, attention_mask=encoder_atts, labels=labels).logits
+            expected = logits.log_softmax(dim=-1).gather(-1, labels.unsqueeze(-1)).squeeze(-1).sum(dim=-1)
+            assert torch.allclose(scores[:, j], expected, atol=1e-5)
@@ -0,0 +1,90 @@
+import numpy as np
+
+NONE = -1 # no valid answer, shown as "None"
+PAD = -2 # empty slot of a shorter last bracket
+
+class Tournament:
+    """
+        Multiple-choice tournament state of a batch of figures
+
+        The remaining classification labels of the figures are kept as a
+        (figures x slots) array of concept ids; the brackets of every level
+        are kept as (figures x brackets x t) arrays. Labels are converted to
+        strings only when building the questions and the output
+    """
+    def __init__(self, concepts, option_lists):
+        """
+            Args:
+                concepts: all classification labels
+                option_lists: remaining classification labels of each figure,
+                    all of the same length
+        """
+        self.concepts = list(concepts)
+        concept2id = {concept: k for k, concept in enumerate(self.concepts)}
+
+        self.state = np.array(
+            [[concept2id.get(concept, NONE) for concept in option_list] for option_list in option_lists],
+            dtype=np.int32
+        ).reshape(len(option_lists), -1)
+        self.levels = []
+
+    def is_finished(self):
+        """Return True if every figure has one label left"""
+        return self.state.shape[1] <= 1
+
+    def create_brackets(self, t, rng):
+        """
+            Shuffle the labels of every figure and split them into brackets
+
+            Args:
+                t: number of options per bracket
+                rng: NumPy random generator
+
+            Returns:
+                (figures x brackets x t) array of concept ids, padded with PAD
+        """
+        state = rng.permuted(self.state, axis=1)
+        num_figures, num_slots = state.shape
+
+        if num_slots >= t:
+            num_brackets = -(-num_slots // t)
+            state = np.pad(state, ((0, 0), (0, num_brackets * t - num_slots)), constant_values=PAD)
+            brackets = state.reshape(num_figures, num_brackets, t)
+        else:
+            brackets = state[:, None, :]
+
+        self.levels.append(brackets)
+
+        return brackets
+
+    def select_winners(self, brackets, choices):
+        """
+            Keep the chosen label of every bracket
+
+            Args:
+                brackets: brackets from create_brackets
+                choices: (figures x brackets) array of chosen option numbers
+                    (1-based, as answered by the LVLM); numbers outside of
+                    the bracket give NONE
+        """
+        lengths = (brackets != PAD).sum(axis=2)
+        index = choices - 1
+
+        valid = (index < lengths) & (index >= -lengths)
+        index = np.where(index < 0, index + lengths, index)
+        index = np.clip(index, 0, brackets.shape[2] - 1)
+
+        winners = np.take_along_axis(brackets, index[..., None], axis=2)[..., 0]
+        self.state = np.where(valid, winners, NONE).astype(np.int32)
+
+    def names(self, concept_ids):
+        """Return the labels of a row of concept ids, skipping PAD"""
+        return [self.concepts[k] if k != NONE else "None" for k in concept_ids.tolist() if k != PAD]
+
+    def winners(self):
+        """Return the remaining labels of every figure"""
+        return [self.names(row) for row in self.state]
+
+    def option_lists(self, j):
+        """Return the labels of every bracket of figure j for each level"""
+        return [[self.names(bracket) for bracket in brackets[j]] for brackets in self.levels]
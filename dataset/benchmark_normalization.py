@@ -0,0 +1,89 @@
+import re
+import time
+import random
+
+from argparse import ArgumentParser
+
+from normalization import normalize_projection, normalize_object
+
+# Labels look like the DeepPatent2 "aspect" and "object" fields: numbered,
+# punctuated, mixed case, some with escape sequences or non-ASCII characters
+PROJECTIONS = ["front", "rear", "left side", "right side", "top plan", "bottom plan", "perspective",
+               "isometric", "cross-sectional", "enlarged detail", "exploded", "elevational"]
+OBJECTS = ["chair", "table", "lamp", "bottle", "shoe", "vehicle", "display screen", "handle",
+           "connector", "wheel", "container", "watch", "speaker", "keyboard", "toy figure"]
+
+def legacy_projection(concept):
+    """Projection preprocessing of create_raw_datasets.py before normalization.py"""
+    def preprocess_concept(concept):
+        concept = concept.encode('utf-8').decode('unicode_escape')
+        concept = re.sub(r'\d+', '', concept)
+        concept = re.sub(r'[^\w\s]', '', concept.lower()).strip()
+        concept = concept.replace(" view", "")
+        return concept
+    return preprocess_concept(concept)
+
+def legacy_object(concept):
+    """Object preprocessing of create_raw_datasets.py before normalization.py"""
+    def preprocess_concept(concept):
+        concept = concept.encode('utf-8').decode('unicode_escape')
+        concept = concept.lower()
+        concept = re.sub(r'\d+', '', concept)
+        concept = re.sub(r'\s+', ' ', concept)
+        concept = re.sub(r'[^\w\s]', '', concept).strip()
+        return concept
+    return preprocess_concept(concept)
+
+def make_label(rng, words):
+    """Return a random raw label built from the words"""
+    label = rng.choice(words)
+    if rng.random() < 0.5: label = label.title() if rng.random() < 0.5 else label.upper()
+    if rng.random() < 0.3: label = f"{label} view"
+    if rng.random() < 0.5: label = f"{label} {rng.randint(1, 40)}{rng.choice(['', 'A', 'B'])}"
+    if rng.random() < 0.3: label = f"{label}{rng.choice(['.', ';', ',', ' -', ')'])}"
+    if rng.random() < 0.1: label = f"{label}  \\u00e9"
+    if rng.random() < 0.05: label = f"{label} café"
+    return label
+
+def make_stream(num_labels, vocabulary_size, seed):
+    """Return num_labels raw labels drawn from a vocabulary with Zipf-like frequencies"""
+    rng = random.Random(seed)
+    vocabulary = list({make_label(rng, words): None
+                       for words in [PROJECTIONS, OBJECTS] * vocabulary_size}.keys())[:vocabulary_size]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    return rng.choices(vocabulary, weights=weights, k=num_labels), len(vocabulary)
+
+def run(normalize, stream):
+    """Normalize the stream, return the labels and labels/s"""
+    start = time.perf_counter()
+    labels = [normalize(concept) for concept in stream]
+    return labels, len(stream) / (time.perf_counter() - start)
+
+def main(num_labels, vocabulary_size, seed):
+
+    stream, vocabulary_size = make_stream(num_labels, vocabulary_size, seed)
+    print(f"{len(stream)} labels, {vocabulary_size} distinct")
+
+    for name, legacy, normalize in [("projection", legacy_projection, normalize_projection),
+                                    ("object", legacy_object, normalize_object)]:
+        normalize.cache_clear()
+
+        legacy_labels, legacy_speed = run(legacy, stream)
+        labels, speed = run(normalize, stream)
+
+        assert labels == legacy_labels, f"{name} labels differ from the legacy preprocessing"
+
+        print(f"{name}: {legacy_speed:,.0f} -> {speed:,.0f} labels/s ({speed / legacy_speed:.1f}x), "
+              f"{normalize.cache_info().currsize} cached")
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+
+    parser.add_argument("--num_labels", type=int, default=1_000_000)
+    parser.add_argument("--vocabulary_size", type=int, default=20_000)
+    parser.add_argument("--seed", type=int, default=1337)
+
+    args = parser.parse_args()
+
+    main(args.num_labels, args.vocabulary_size, args.seed)
@@ -1,5 +1,5 @@
-import re
 import os
+import sys
 import json
 import random
 
@@ -15,6 +15,11 @@ from nltk.corpus import stopwords
 
 from sentence_transformers import SentenceTransformer, models
 
+# normalization.py is in the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from normalization import normalize_object
+
 nltk.download('stopwords', quiet=True)
 stopwords = set(stopwords.words('english'))
 
@@ -46,15 +51,6 @@ model.eval()
 
 workers = 32
 
-def preprocess_concept(concept):
-    """Preprocess concept label"""
-    concept = concept.encode('utf-8').decode('unicode_escape')
-    concept = concept.lower()
-    concept = re.sub(r'\d+', '', concept)
-    concept = re.sub(r'\s+', ' ', concept)
-    concept = re.sub(r'[^\w\s]', '', concept).strip()
-    return concept
-
 def get_patent_bert_embeddings(concepts):
     """Get PatentBERT embeddings for the list of concepts"""
     with torch.inference_mode():
@@ -121,7 +117,7 @@ def main():
 
     with open("object_concepts.json", "r") as rf:
         object_concepts = json.load(rf)["concepts"]
-        concepts = list(set([preprocess_concept(concept) for concept in object_concepts]))
+        concepts = list(set([normalize_object(concept) for concept in object_concepts]))
 
     print(f"Found {len(concepts)} concepts")
 
@@ -1,19 +1,17 @@
-import re
+import os
+import sys
 import json
 import nltk
 
-def preprocess_concept(concept):
-    """Preprocess concept label"""
-    concept = concept.encode('utf-8').decode('unicode_escape')
-    concept = re.sub(r'\d+', '', concept)
-    concept = re.sub(r'[^\w\s]', '', concept.lower()).strip()
-    concept = concept.replace(" view", "")
-    return concept
+# normalization.py is in the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from normalization import normalize_projection
 
 with open("projection_concepts.json", "r") as rf:
     """Get list of all projection concepts"""
     projection_concepts = json.load(rf)["concepts"]
-    concepts = [preprocess_concept(concept) for concept in projection_concepts]
+    concepts = [normalize_projection(concept) for concept in projection_concepts]
 
 projection_hierarchy = {
     "projections": {
@@ -1,11 +1,13 @@
 import os
-import re
 import csv
 import random
 
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
 
 from utils import id_wrapper, load_json, save_json, get_patent_id, get_config
+from utils import iter_json_array, write_json_object
+from normalization import normalize_projection, normalize_object
 
 def set_seed(seed):
     random.seed(seed)
@@ -25,31 +27,16 @@ uspc2title = load_json("concepts/uspc2title.json")
 
 def fetch_projection(concept):
     """Fetch projection label"""
-    def preprocess_concept(concept):
-        concept = concept.encode('utf-8').decode('unicode_escape')
-        concept = re.sub(r'\d+', '', concept)
-        concept = re.sub(r'[^\w\s]', '', concept.lower()).strip()
-        concept = concept.replace(" view", "")
-        return concept
-    
     try:
-        return concept2projection[preprocess_concept(concept)].lower()
-    except (KeyError, AttributeError):
+        return concept2projection[normalize_projection(concept)].lower()
+    except (KeyError, AttributeError, TypeError):
         return None
     
 def fetch_object(concept):
     """Fetch object label"""
-    def preprocess_concept(concept):
-        concept = concept.encode('utf-8').decode('unicode_escape')
-        concept = concept.lower()
-        concept = re.sub(r'\d+', '', concept)
-        concept = re.sub(r'\s+', ' ', concept)
-        concept = re.sub(r'[^\w\s]', '', concept).strip()
-        return concept
-    
     try:
-        return concept2object[preprocess_concept(concept)].lower()
-    except (KeyError, AttributeError):
+        return concept2object[normalize_object(concept)].lower()
+    except (KeyError, AttributeError, TypeError):
         return None
 
 def format_uspc(uspc):
@@ -109,51 +96,131 @@ def prepare_clef_ip_dataset(idx):
 
     return idx
 
-def prepare_deeppatent2_dataset(idx):
-    """Prepare DeepPatent2 dataset"""
+DEEPPATENT2_ROOT_DIR = f"{ROOT_DIR}/deeppatent2"
+WORKERS = 16
 
-    DEEPPATENT2_ROOT_DIR = f"{ROOT_DIR}/deeppatent2"
-    YEARS = range(2007, 2020+1, 1)
+def update_labels(sample, labels):
+    """
+        Return the (projection, object, uspc_id, uspc_title) labels of a sample
 
-    projection2idx = {}
-    object2idx = {}
-    uspc2idx = {}
+        A sample with an empty label keeps the label of the previous sample,
+        passed as labels (also across years)
+    """
+    projection, object, uspc_id, uspc_title = labels
+
+    # Projection
+    if "aspect" in sample:
+        if sample["aspect"]:
+            projection = fetch_projection(sample["aspect"])
+    else:
+        projection = None
+
+    # Object
+    if "object" in sample:
+        if sample["object"]:
+            object = fetch_object(sample["object"])
+    else:
+        object = None
 
-    for year in YEARS:
+    # USPC
+    if "classification_national" in sample:
+        if sample["classification_national"]:
+            uspc_id = format_uspc(sample["classification_national"])
+            uspc_title = fetch_uspc_title(uspc_id)
+    else:
+        uspc_id, uspc_title = None, None
     
-        raw_data = {}
-        data = load_json(f"{DEEPPATENT2_ROOT_DIR}/{year}/design{year}.json")
-
-        for sample in tqdm(data, desc=f"DeepPatent2/{year}"):
-            
-            # Projection
-            if "aspect" in sample:
-                if sample["aspect"]:
-                    projection = fetch_projection(sample["aspect"])
-            else:
-                projection = None
+    projection = projection if projection else "None"
+    object = object if object else "None"
+    uspc_id = uspc_id[0] + "/" + uspc_id[1] if uspc_id else "None"
+    uspc_title = uspc_title if uspc_title else "None"
+
+    return projection, object, uspc_id, uspc_title
+
+def count_deeppatent2_year(year):
+    """
+        Count the subfigures of a DeepPatent2 year file and summarize the labels
+        its last sample carries over to the next year, see carry_labels
+
+        Returns:
+            count: number of subfigures
+            labels: labels of the last sample, starting the year without labels
+            is_set: whether a sample of the year sets each label (instead of
+                keeping the label carried into the year)
+            uspc_kept: number of samples after the last one setting the USPC labels
+    """
+    count = 0
+    labels = (None, None, None, None)
+    is_set = [False, False, False]
+    uspc_kept = 0
+
+    for sample in iter_json_array(f"{DEEPPATENT2_ROOT_DIR}/{year}/design{year}.json"):
+        labels = update_labels(sample, labels)
+
+        is_set[0] |= "aspect" not in sample or bool(sample["aspect"])
+        is_set[1] |= "object" not in sample or bool(sample["object"])
+
+        if "classification_national" not in sample or sample["classification_national"]:
+            is_set[2] = True
+            uspc_kept = 0
+        else:
+            uspc_kept += 1
 
-            # Object
-            if "object" in sample:
-                if sample["object"]:
-                    object = fetch_object(sample["object"])
-            else:
-                object = None
+        count += 1
 
-            # USPC
-            if "classification_national" in sample:
-                if sample["classification_national"]:
-                    uspc_id = format_uspc(sample["classification_national"])
-                    uspc_title = fetch_uspc_title(uspc_id)
-            else:
-                uspc_id, uspc_title = None, None
-            
-            projection = projection if projection else "None"
-            object = object if object else "None"
+    return count, labels, is_set, uspc_kept
+
+def carry_labels(previous, count, labels, is_set, uspc_kept):
+    """
+        Return the labels carried out of a year given the labels carried into
+        it and the summary of count_deeppatent2_year
+
+        A label that no sample of the year sets is the carried label; the
+        uspc_id is reformatted by every sample keeping it, as in update_labels
+    """
+    if count == 0: return previous
+
+    projection, object, uspc_id, uspc_title = labels
+
+    if not is_set[0]: projection = previous[0] if previous[0] else "None"
+    if not is_set[1]: object = previous[1] if previous[1] else "None"
+
+    if not is_set[2]:
+        uspc_id, uspc_title = previous[2], previous[3] if previous[3] else "None"
+        # the reformatting reaches a fixed point after two samples
+        for _ in range(min(uspc_kept, 3)):
             uspc_id = uspc_id[0] + "/" + uspc_id[1] if uspc_id else "None"
-            uspc_title = uspc_title if uspc_title else "None"
 
-            raw_data[id_wrapper(idx)] = {
+    return projection, object, uspc_id, uspc_title
+
+def prepare_deeppatent2_year(year, idx, labels):
+    """
+        Prepare the raw dataset of one DeepPatent2 year
+
+        The year file is streamed and the samples are written to {year}.json as
+        they are read. The ids start at idx, the pre-counted number of samples
+        before this year, and the labels carried over from the previous year are
+        pre-computed, so the output does not depend on the order the years are run in
+
+        Args:
+            year: DeepPatent2 year
+            idx: id of the first sample of the year
+            labels: labels of the last sample of the previous year, see carry_labels
+
+        Returns:
+            projection2idx, object2idx and uspc2idx of the year
+    """
+    projection2idx = {}
+    object2idx = {}
+    uspc2idx = {}
+
+    def samples(idx, labels):
+        for sample in iter_json_array(f"{DEEPPATENT2_ROOT_DIR}/{year}/design{year}.json"):
+
+            labels = update_labels(sample, labels)
+            projection, object, uspc_id, uspc_title = labels
+
+            yield id_wrapper(idx), {
                 "patent_id": sample["patentID"],
                 "figure_file": sample["subfigure_file"],
                 "dir": f"{year}/Segmentednew/",
@@ -170,15 +237,57 @@ def prepare_deeppatent2_dataset(idx):
 
             idx += 1
 
-        save_json(raw_data, f"{WRITE_DIR}/{year}.json")
+    write_json_object(samples(idx, labels), f"{WRITE_DIR}/{year}.json")
+
+    return projection2idx, object2idx, uspc2idx
+
+def prepare_deeppatent2_dataset(idx):
+    """
+        Prepare DeepPatent2 dataset
+
+        The years are counted and prepared in parallel; each year gets the id
+        range following the previous years and the labels carried over from the
+        previous year, and the label to ids mappings are merged in year order,
+        so the output matches a sequential run
+    """
+    YEARS = range(2007, 2020+1, 1)
+
+    projection2idx = {}
+    object2idx = {}
+    uspc2idx = {}
+
+    with ProcessPoolExecutor(max_workers=WORKERS) as executor:
+
+        summaries = list(tqdm(executor.map(count_deeppatent2_year, YEARS), total=len(YEARS),
+                              desc="DeepPatent2/count"))
+
+        start_ids = []
+        start_labels = []
+        labels = (None, None, None, None)
+
+        for summary in summaries:
+            start_ids.append(idx)
+            start_labels.append(labels)
+            idx += summary[0]
+            labels = carry_labels(labels, *summary)
+
+        futures = [executor.submit(prepare_deeppatent2_year, year, start_idx, labels)
+                        for year, start_idx, labels in zip(YEARS, start_ids, start_labels)]
+
+        for year, future in zip(YEARS, tqdm(futures, desc="DeepPatent2")):
+            year_projection2idx, year_object2idx, year_uspc2idx = future.result()
+
+            for label, ids in year_projection2idx.items(): projection2idx.setdefault(label, []).extend(ids)
+            for label, ids in year_object2idx.items(): object2idx.setdefault(label, []).extend(ids)
+            for label, ids in year_uspc2idx.items(): uspc2idx.setdefault(label, []).extend(ids)
     
     del projection2idx["None"]
     del object2idx["None"]
     del uspc2idx["None"]
 
-    save_json(projection2idx, f"{WRITE_DIR}/projection2idx.json")
-    save_json(object2idx, f"{WRITE_DIR}/object2idx.json")
-    save_json(uspc2idx, f"{WRITE_DIR}/uspc2idx.json")
+    save_json(projection2idx, f"{WRITE_DIR}/projection2idx.json", compact=True)
+    save_json(object2idx, f"{WRITE_DIR}/object2idx.json", compact=True)
+    save_json(uspc2idx, f"{WRITE_DIR}/uspc2idx.json", compact=True)
 
 if __name__ == "__main__":
 
@@ -1,89 +1,71 @@
 import os
-import io
-
-from PIL import Image
-
-import webdataset as wds
 
 import asyncio
-import aiofiles
 
-from torchvision import transforms as T
-from concurrent.futures import ProcessPoolExecutor
-
-from utils import load_json, get_config
+from utils import load_json, save_json, get_config
+from shard_utils import write_shards, write_index, ImageStore, BlobStore
 
 CONFIG = get_config()
 ROOT_DIR = CONFIG['root_dir']
 WRITE_DIR = f"{ROOT_DIR}/vqa"
-
-BATCH_SIZE = 512
-
-def get_batches(_list, batch_size=512):
-    """Batch list into batches of size batch_size"""
-    batches = [_list[i:i + batch_size] for i in range(0, len(_list), batch_size)]
-    return batches
-
-def expand2square(image):
-    """Expand image to square."""
-    width, height = image.size
-    
-    if width == height:
-        return image
-    elif width > height:
-        result = Image.new(image.mode, (width, width), color="white")
-        result.paste(image, (0, (width - height) // 2))
-        return result
-    else:
-        result = Image.new(image.mode, (height, height), color="white")
-        result.paste(image, ((height - width) // 2, 0))
-        return result
-    
-async def get_image(path):
-    """Get image"""
-    async with aiofiles.open(os.path.join(ROOT_DIR, path), mode="rb") as f:
-        image_data = await f.read()
-
-    image = Image.open(io.BytesIO(image_data))
-    image_resized = T.Compose([
-        expand2square,
-        T.Grayscale(num_output_channels=3),
-        T.Resize((324, 324), interpolation=T.InterpolationMode.BICUBIC)
-    ])(image)
-
-    img_byte_arr = io.BytesIO()
-    image_resized.save(img_byte_arr, format="PNG")
-
-    return img_byte_arr.getvalue()
-
-async def write_to_shard(data):
-    
-    _batch, split, aspect = data
-    idx, batch = _batch
-
-    write_dir = os.path.join(WRITE_DIR, aspect, split, f"shard-{int(idx):06d}.tar")
-
-    aspect = aspect.split("/")[0]
-
-    with wds.TarWriter(write_dir, encoder=False) as sink:
-        
-        for id, sample in batch:
-            
-            image = await get_image(sample['figure_path'])
-
-            sink.write({
-                "__key__": f"{id}",
-                "label.txt": sample[aspect].encode("utf-8"),
-                "image.png": image
+STORE_DIR = f"{ROOT_DIR}/image_store"
+
+# "tar": webdataset shards holding the figures, "blob": an index.json per split
+# pointing into a shared BlobStore, every figure stored once
+SHARD_LAYOUT = "tar"
+
+# encoding of the figures, "png" or a raw single-channel array ("npy", "npy.zst", "npy.lz4")
+IMAGE_FORMAT = "png"
+
+MAX_SHARD_BYTES = 256 * 1024**2
+SEED = 1337
+WORKERS = 16
+
+def make_record(id, sample, image, aspect):
+    """Return the webdataset sample of a figure"""
+    return {
+        "__key__": f"{id}",
+        "label.txt": sample[aspect].encode("utf-8"),
+        f"image.{IMAGE_FORMAT}": image
+    }
+
+def write_manifest(batches, split, aspect, shards=True):
+    """
+        Write the manifest of a split next to its shards
+
+        The manifest lists the keys and labels of all samples in shard order
+        and the offset of each shard, so that readers can get the ids, labels
+        and size of a split without decoding any image
+
+        Args:
+            batches: list of (shard index, [(id, sample), ...]) of the split
+            split: split name
+            aspect: aspect name
+            shards: list the shard offsets (False for the blob layout)
+    """
+    label_aspect = aspect.split("/")[0]
+
+    manifest = {"keys": [], "labels": [], "shards": []}
+
+    for idx, batch in batches:
+        if shards:
+            manifest["shards"].append({
+                "shard": f"shard-{int(idx):06d}.tar",
+                "offset": len(manifest["keys"]),
+                "count": len(batch)
             })
 
-    print(f"Created shard-{int(idx):06d}.tar")
+        for id, sample in batch:
+            manifest["keys"].append(f"{id}")
+            manifest["labels"].append(sample[label_aspect])
 
-def process_batch(data):
-    asyncio.run(write_to_shard(data))
+    save_json(manifest, os.path.join(WRITE_DIR, aspect, split, "manifest.json"))
 
 async def main():
 
+    store = ImageStore(STORE_DIR)
+    blobs = BlobStore(os.path.join(STORE_DIR, "blobs")) if SHARD_LAYOUT == "blob" else None
+
     for aspect in ["type", "projection", "object", "uspc"]:
 
         for split in ["train_9", "train_18", "train_27", "train_54", "train_81", "train_150", "test", "val"]:
@@ -94,27 +76,34 @@ async def main():
                 os.path.join("dataset", "classification", aspect, f"{split}.json")
             )
 
-            os.makedirs(os.path.join(WRITE_DIR, aspect, split), exist_ok=True)
-
-            batch_ids = get_batches(list(data.keys()), batch_size=BATCH_SIZE*10)
-            batches = [(idx, [(id, data[id]) for id in batch]) for idx, batch in enumerate(batch_ids)]
-            
-            loop = asyncio.get_event_loop()
-
-            with ProcessPoolExecutor(max_workers=16) as executor:
-                tasks = [loop.run_in_executor(executor, process_batch, 
-                                            (batch, split, aspect)) for batch in batches]
-                await asyncio.gather(*tasks)
+            label_aspect = aspect.split("/")[0]
+
+            if SHARD_LAYOUT == "blob":
+                batches = await write_index(
+                    list(data.items()),
+                    os.path.join(WRITE_DIR, aspect, split),
+                    lambda id, sample, image: make_record(id, sample, image, label_aspect),
+                    ROOT_DIR,
+                    store,
+                    blobs,
+                    seed=SEED,
+                    workers=WORKERS,
+                    image_format=IMAGE_FORMAT
+                )
+            else:
+                batches = await write_shards(
+                    list(data.items()),
+                    os.path.join(WRITE_DIR, aspect, split),
+                    lambda id, sample, image: make_record(id, sample, image, label_aspect),
+                    ROOT_DIR,
+                    MAX_SHARD_BYTES,
+                    seed=SEED,
+                    workers=WORKERS,
+                    store=store,
+                    image_format=IMAGE_FORMAT
+                )
+
+            write_manifest(batches, split, aspect, shards=SHARD_LAYOUT == "tar")
 
 if __name__ == '__main__':
     asyncio.run(main())
-
-    
-
-
-
-
-
-        
-
-
@@ -4,6 +4,7 @@ import random
 from tqdm import tqdm
 
 from utils import load_json, save_json, get_config
+from normalization import normalize_projection, normalize_object
 
 def set_seed(seed):
     random.seed(seed)
@@ -41,8 +42,12 @@ for year in YEARS:
 object_concepts["concepts"] = list(object_concepts["concepts"])
 projection_concepts["concepts"] = list(projection_concepts["concepts"])
 
-print(f"Total object concepts: {len(object_concepts['concepts'])}")
-print(f"Total projection concepts: {len(projection_concepts['concepts'])}")
+# the clustering scripts work on the normalized labels
+num_objects = len(set(map(normalize_object, object_concepts["concepts"])))
+num_projections = len(set(map(normalize_projection, projection_concepts["concepts"])))
+
+print(f"Total object concepts: {len(object_concepts['concepts'])} ({num_objects} normalized)")
+print(f"Total projection concepts: {len(projection_concepts['concepts'])} ({num_projections} normalized)")
 
 save_json(object_concepts, f"{WRITE_DIR}/object_concepts.json")
 save_json(projection_concepts, f"{WRITE_DIR}/projection_concepts.json")
\ No newline at end of file
@@ -0,0 +1,35 @@
+import re
+import functools
+
+# Normalization of the DeepPatent2 projection ("aspect") and object labels.
+# The raw label vocabulary is small compared to the number of samples, so
+# the normalized label of every raw label is memoized
+
+DIGITS = re.compile(r'\d+')
+WHITESPACE = re.compile(r'\s+')
+PUNCTUATION = re.compile(r'[^\w\s]')
+
+def unescape(concept):
+    """Decode the escape sequences in a label (e.g. '\\u00e9')"""
+    # unicode_escape leaves ASCII labels without a backslash unchanged
+    if concept.isascii() and "\\" not in concept:
+        return concept
+    return concept.encode('utf-8').decode('unicode_escape')
+
+@functools.lru_cache(maxsize=None)
+def normalize_projection(concept):
+    """Preprocess projection label"""
+    concept = unescape(concept)
+    concept = DIGITS.sub('', concept)
+    concept = PUNCTUATION.sub('', concept.lower()).strip()
+    concept = concept.replace(" view", "")
+    return concept
+
+@functools.lru_cache(maxsize=None)
+def normalize_object(concept):
+    """Preprocess object label"""
+    concept = unescape(concept).lower()
+    concept = DIGITS.sub('', concept)
+    concept = WHITESPACE.sub(' ', concept)
+    concept = PUNCTUATION.sub('', concept).strip()
+    return concept
@@ -0,0 +1,114 @@
+import os
+import io
+import mmap
+import json
+import random
+import contextlib
+
+import numpy as np
+
+from PIL import Image
+
+import torch
+
+# Reading side of shard_utils.py, shared by the classifier and the baselines
+# (imported with the dataset directory appended to sys.path, so this module
+# must not import the other dataset modules)
+
+# image members of a sample, see IMAGE_FORMATS in shard_utils.py
+IMAGE_KEYS = "image.png;image.npy;image.npy.zst;image.npy.lz4"
+
+def load_image(image_data, as_tensor=False):
+    """
+        Decode a figure encoded as PNG or as a (compressed) single-channel uint8 array
+
+        The format is detected from the magic bytes, so blob files need no format field
+
+        Args:
+            image_data: encoded figure
+            as_tensor: return arrays as 3 x H x W uint8 tensors, expanded from
+                the single channel without a copy, instead of RGB PIL images
+
+        Returns:
+            PIL image (PNG, or array without as_tensor) or uint8 tensor
+    """
+    if image_data[:4] == b"\x28\xb5\x2f\xfd": # zstandard frame
+        import zstandard
+        image_data = zstandard.ZstdDecompressor().decompress(image_data)
+    elif image_data[:4] == b"\x04\x22\x4d\x18": # LZ4 frame
+        import lz4.frame
+        image_data = lz4.frame.decompress(image_data)
+
+    if image_data[:6] == b"\x93NUMPY":
+        array = np.load(io.BytesIO(image_data))
+        if as_tensor:
+            return torch.from_numpy(array)[None].expand(3, -1, -1)
+        return Image.fromarray(array).convert("RGB")
+
+    image = Image.open(io.BytesIO(image_data))
+    image.load()
+    return image
+
+class BlobIndexDataset(torch.utils.data.IterableDataset):
+    """
+        Split in the blob layout of shard_utils.py
+
+        index.json lists the samples of the split with the [offset, length] of
+        their figure in a blob file shared by all splits, which is memory-mapped
+        by each loader worker
+    """
+    def __init__(self, index_path, decode, label_fn, shuffle=False, seed=0, timer=None):
+        """
+            Args:
+                index_path: index.json of the split
+                decode: function decoding a figure
+                label_fn: function mapping a label to the returned label
+                shuffle: shuffle the samples every epoch
+                seed: seed of the shuffle
+                timer: function returning a context manager timing a stage,
+                    used to time the blob reads as "read" (optional)
+        """
+        with open(index_path) as f: index = json.load(f)
+        self.records = index["records"]
+        self.blob_path = os.path.join(os.path.dirname(index_path), index["blobs"])
+        self.decode = decode
+        self.label_fn = label_fn
+        self.shuffle = shuffle
+        self.seed = seed
+        self.timer = timer
+        self.epoch = 0
+        self.blobs = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["blobs"] = None # reopened by each loader worker
+        return state
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        if self.blobs is None:
+            with open(self.blob_path, "rb") as f:
+                self.blobs = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        order = list(range(len(self.records)))
+        worker = torch.utils.data.get_worker_info()
+
+        if self.shuffle:
+            # the workers of an epoch share the base seed, so they split the same order
+            seed = worker.seed - worker.id if worker is not None else self.seed + self.epoch
+            random.Random(seed).shuffle(order)
+            self.epoch += 1
+
+        if worker is not None:
+            order = order[worker.id::worker.num_workers]
+
+        for i in order:
+            record = self.records[i]
+            offset, length = record["image"]
+
+            with self.timer("read") if self.timer is not None else contextlib.nullcontext():
+                image = self.blobs[offset:offset+length]
+
+            yield record["__key__"], self.decode(image), self.label_fn(record["label.txt"])
@@ -0,0 +1,404 @@
+import os
+import io
+import json
+import time
+import glob
+import hashlib
+import random
+import asyncio
+import collections
+
+import aiofiles
+import numpy as np
+import webdataset as wds
+
+from PIL import Image
+
+from torchvision import transforms as T
+from concurrent.futures import ProcessPoolExecutor
+
+def expand2square(image):
+    """Expand image to square."""
+    width, height = image.size
+
+    if width == height:
+        return image
+    elif width > height:
+        result = Image.new(image.mode, (width, width), color="white")
+        result.paste(image, (0, (width - height) // 2))
+        return result
+    else:
+        result = Image.new(image.mode, (height, height), color="white")
+        result.paste(image, ((height - width) // 2, 0))
+        return result
+
+# parameters of the figure preprocessing, part of the ImageStore keys
+TRANSFORM_PARAMS = {
+    "expand2square": True,
+    "grayscale_channels": 3,
+    "size": [324, 324],
+    "interpolation": "bicubic"
+}
+
+# figure encodings, used as the extension of the image member of a sample:
+# "png" (3-channel PNG) or "npy" (single-channel uint8 array in .npy format),
+# optionally compressed with zstandard ("npy.zst") or LZ4 ("npy.lz4")
+IMAGE_FORMATS = ["png", "npy", "npy.zst", "npy.lz4"]
+
+transform = T.Compose([
+    expand2square,
+    T.Grayscale(num_output_channels=TRANSFORM_PARAMS["grayscale_channels"]),
+    T.Resize(tuple(TRANSFORM_PARAMS["size"]), interpolation=T.InterpolationMode.BICUBIC)
+])
+
+def encode_image(image, image_format="png"):
+    """
+        Encode a resized figure in one of IMAGE_FORMATS
+
+        The figures are grayscale, so the "npy" formats keep a single channel;
+        readers expand it to 3 channels
+    """
+    img_byte_arr = io.BytesIO()
+
+    if image_format == "png":
+        image.save(img_byte_arr, format="PNG")
+        return img_byte_arr.getvalue()
+
+    np.save(img_byte_arr, np.asarray(image)[:, :, 0])
+    image_bytes = img_byte_arr.getvalue()
+
+    if image_format == "npy.zst":
+        import zstandard
+        return zstandard.ZstdCompressor(level=3).compress(image_bytes)
+
+    if image_format == "npy.lz4":
+        import lz4.frame
+        return lz4.frame.compress(image_bytes)
+
+    if image_format != "npy":
+        raise ValueError(f"Unknown image format {image_format}, expected one of {IMAGE_FORMATS}")
+
+    return image_bytes
+
+def resize_image(image_data, image_format="png", store_path=None):
+    """
+        Resize an encoded figure and encode it in image_format (runs in the process pool)
+
+        With store_path, the encoded figure is also saved to the ImageStore
+    """
+    image = transform(Image.open(io.BytesIO(image_data)))
+    image_bytes = encode_image(image, image_format)
+
+    if store_path is not None:
+        ImageStore.write(store_path, image_bytes)
+
+    return image_bytes
+
+class ImageStore:
+    """
+        Content-addressed store of resized figures
+
+        A figure is stored under a hash of its source path, size and
+        modification time and of TRANSFORM_PARAMS, so a figure is only resized
+        again if the source file or the preprocessing changed. Figures shared
+        by several aspects and splits are resized once
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.transform_id = json.dumps(TRANSFORM_PARAMS, sort_keys=True)
+
+    def get_key(self, path, image_format="png"):
+        """Return the key of the resized figure of a source file in image_format"""
+        stat = os.stat(path)
+        data = json.dumps([os.path.abspath(path), stat.st_size, stat.st_mtime_ns, self.transform_id, image_format])
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.store_dir, key[:2], key)
+
+    @staticmethod
+    def write(path, image_bytes):
+        """Write a figure atomically, so an interrupted write leaves no partial figure"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.{os.getpid()}.tmp", "wb") as f: f.write(image_bytes)
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+async def read_file(path, semaphore):
+    """Read a file with at most semaphore concurrent reads"""
+    async with semaphore:
+        async with aiofiles.open(path, mode="rb") as f:
+            return await f.read()
+
+def get_sample_size(record):
+    """Size of a sample in the tar file (512 byte header and padding per member)"""
+    return sum(512 + -(-len(value) // 512) * 512 for key, value in record.items() if key != "__key__")
+
+async def iter_images(samples, root_dir, store=None, keys=None, stats=None, workers=16, max_reads=64, window=512,
+                      image_format="png"):
+    """
+        Yield (sample index, resized figure) for the samples, in sample order
+
+        The figures are read concurrently (at most max_reads files at a time)
+        and resized and PNG encoded in a process pool, with at most window
+        samples in flight. With a store, stored figures are read from the store
+        and resized figures are added to it
+
+        Args:
+            samples: list of (id, sample) with the figure path in sample['figure_path']
+            root_dir: directory the figure paths are relative to
+            store: ImageStore of resized figures (optional)
+            keys: ImageStore keys of the samples (required with a store)
+            stats: Counter of the number of "resized" figures (optional)
+            workers: number of resize/encode processes
+            max_reads: maximum number of concurrent file reads
+            window: maximum number of samples read or encoded ahead of the consumer
+            image_format: encoding of the figures, see IMAGE_FORMATS
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max_reads)
+    stats = stats if stats is not None else collections.Counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+
+        async def process(i, sample):
+            store_path = None
+            if store is not None:
+                store_path = store.get_path(keys[i])
+                if os.path.isfile(store_path):
+                    return await read_file(store_path, semaphore)
+
+            image_data = await read_file(os.path.join(root_dir, sample["figure_path"]), semaphore)
+            stats["resized"] += 1
+            return await loop.run_in_executor(executor, resize_image, image_data, image_format, store_path)
+
+        pending = collections.deque()
+        queued = iter(enumerate(samples))
+
+        def fill():
+            while len(pending) < window:
+                i, item = next(queued, (None, None))
+                if item is None: return
+                pending.append((i, asyncio.ensure_future(process(i, item[1]))))
+
+        fill()
+
+        try:
+            while pending:
+                i, task = pending.popleft()
+                image = await task
+                fill()
+                yield i, image
+        finally:
+            for _, task in pending: task.cancel()
+
+def get_fingerprint(samples, keys, make_record, max_shard_bytes, seed):
+    """Return a fingerprint of the shards built from the samples"""
+    records = [make_record(id, sample, b"") for id, sample in samples]
+    data = json.dumps([
+        [{name: value.decode("utf-8", "replace") if isinstance(value, bytes) else value
+            for name, value in record.items()} for record in records],
+        keys, max_shard_bytes, seed
+    ])
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+async def write_shards(samples, write_dir, make_record, root_dir, max_shard_bytes, seed=None,
+                       workers=16, max_reads=64, window=512, store=None, image_format="png"):
+    """
+        Write samples to webdataset shards of about max_shard_bytes
+
+        The figures are read and resized concurrently (see iter_images) and
+        written in sample order by a single writer, which starts a new shard
+        when the next sample would exceed max_shard_bytes. The shard layout
+        only depends on the samples, the seed and max_shard_bytes
+
+        Args:
+            samples: list of (id, sample) with the figure path in sample['figure_path']
+            write_dir: directory of the shards, existing shards are replaced
+            make_record: function (id, sample, image bytes) -> webdataset sample dict
+            root_dir: directory the figure paths are relative to
+            max_shard_bytes: target shard size in bytes
+            seed: seed of the sample order (optional, key order if None)
+            workers: number of resize/encode processes
+            max_reads: maximum number of concurrent file reads
+            window: maximum number of samples read or encoded ahead of the writer
+            store: ImageStore of resized figures (optional); stored figures are
+                read from the store, only new or changed figures are resized,
+                and shards are not rewritten if the samples, figures and
+                settings are the same as in the last run
+            image_format: encoding of the figures, see IMAGE_FORMATS
+
+        Returns:
+            list of (shard index, [(id, sample), ...]) as written
+    """
+    samples = list(samples)
+    if seed is not None:
+        random.Random(seed).shuffle(samples)
+
+    os.makedirs(write_dir, exist_ok=True)
+
+    layout_path = os.path.join(write_dir, "layout.json")
+
+    if store is not None:
+        keys = [store.get_key(os.path.join(root_dir, sample["figure_path"]), image_format) for _, sample in samples]
+        fingerprint = get_fingerprint(samples, keys, make_record, max_shard_bytes, seed)
+
+        if os.path.isfile(layout_path):
+            with open(layout_path, "r") as f: layout = json.load(f)
+
+            shards = [os.path.join(write_dir, f"shard-{idx:06d}.tar") for idx in range(len(layout["shards"]))]
+
+            if layout["fingerprint"] == fingerprint and all(os.path.isfile(shard) for shard in shards):
+                print(f"{write_dir} is up to date")
+                data = dict(samples)
+                return [(idx, [(id, data[id]) for id in ids]) for idx, ids in enumerate(layout["shards"])]
+
+    for path in [layout_path, os.path.join(write_dir, "index.json")]:
+        if os.path.isfile(path): os.remove(path)
+    for shard in glob.glob(os.path.join(write_dir, "shard-*.tar")):
+        os.remove(shard)
+
+    batches = []
+    sink, shard_bytes = None, 0
+    stats = collections.Counter()
+    start = time.perf_counter()
+
+    try:
+        images = iter_images(samples, root_dir, store, keys if store is not None else None, stats,
+                             workers, max_reads, window, image_format)
+
+        async for i, image in images:
+            id, sample = samples[i]
+            record = make_record(id, sample, image)
+
+            size = get_sample_size(record)
+
+            if sink is None or (shard_bytes and shard_bytes + size > max_shard_bytes):
+                if sink is not None: sink.close()
+                batches.append((len(batches), []))
+                sink = wds.TarWriter(os.path.join(write_dir, f"shard-{len(batches)-1:06d}.tar"), encoder=False)
+                shard_bytes = 0
+
+            sink.write(record)
+            shard_bytes += size
+            batches[-1][1].append((id, sample))
+    finally:
+        if sink is not None: sink.close()
+
+    if store is not None:
+        with open(layout_path, "w") as f:
+            json.dump({"fingerprint": fingerprint, "shards": [[id for id, _ in batch] for _, batch in batches]}, f)
+
+    elapsed = time.perf_counter() - start
+    print(f"{len(samples)} images ({stats['resized']} resized) in {len(batches)} shards, {elapsed:.1f}s "
+          f"({len(samples) / max(elapsed, 1e-9):.1f} images/s)")
+
+    return batches
+
+class BlobStore:
+    """
+        Packed store of resized figures for the blob shard layout
+
+        The figures are appended once to blobs.bin, a single file that readers
+        memory-map, and blobs.json maps the ImageStore key of a figure to its
+        [offset, length] in blobs.bin. Figures shared by splits, aspects and
+        VQA questions are stored once
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.blob_path = os.path.join(store_dir, "blobs.bin")
+        self.index_path = os.path.join(store_dir, "blobs.json")
+
+        os.makedirs(store_dir, exist_ok=True)
+
+        self.index = {}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, "r") as f: self.index = json.load(f)
+
+    async def add(self, samples, keys, root_dir, store, workers=16, max_reads=64, window=512, image_format="png"):
+        """
+            Append the figures of the samples that are not in the store yet
+
+            Returns:
+                Number of appended figures
+        """
+        missing = {}
+        for i, key in enumerate(keys):
+            if key not in self.index: missing.setdefault(key, i)
+
+        if not missing: return 0
+
+        indices = list(missing.values())
+
+        # figures are appended after the end of the last indexed figure; bytes
+        # of an interrupted run that were not indexed are overwritten
+        end = max((offset + length for offset, length in self.index.values()), default=0)
+
+        with open(self.blob_path, "r+b" if os.path.isfile(self.blob_path) else "wb") as f:
+            f.seek(end)
+
+            images = iter_images([samples[i] for i in indices], root_dir, store, [keys[i] for i in indices],
+                                 workers=workers, max_reads=max_reads, window=window, image_format=image_format)
+
+            async for j, image in images:
+                self.index[keys[indices[j]]] = [f.tell(), len(image)]
+                f.write(image)
+
+            f.truncate()
+
+        with open(f"{self.index_path}.tmp", "w") as f: json.dump(self.index, f)
+        os.replace(f"{self.index_path}.tmp", self.index_path)
+
+        return len(indices)
+
+async def write_index(samples, write_dir, make_record, root_dir, store, blobs, seed=None,
+                      workers=16, max_reads=64, window=512, image_format="png"):
+    """
+        Write a split in the blob layout
+
+        Instead of tar shards, the split directory holds index.json with the
+        fields of every sample (key, label, question, ...) and the [offset,
+        length] of its figure in the BlobStore, referenced by a path relative
+        to the split directory
+
+        Args:
+            samples: list of (id, sample) with the figure path in sample['figure_path']
+            write_dir: directory of the split, existing shards are removed
+            make_record: function (id, sample, image bytes) -> webdataset sample dict
+            root_dir: directory the figure paths are relative to
+            store: ImageStore of resized figures
+            blobs: BlobStore to add the figures to
+            seed: seed of the sample order (optional, key order if None)
+            workers, max_reads, window, image_format: see iter_images
+
+        Returns:
+            list of (0, [(id, sample), ...]) as written
+    """
+    samples = list(samples)
+    if seed is not None:
+        random.Random(seed).shuffle(samples)
+
+    start = time.perf_counter()
+
+    keys = [store.get_key(os.path.join(root_dir, sample["figure_path"]), image_format) for _, sample in samples]
+    added = await blobs.add(samples, keys, root_dir, store, workers, max_reads, window, image_format)
+
+    records = []
+    for (id, sample), key in zip(samples, keys):
+        record = {name: value.decode("utf-8") if isinstance(value, bytes) else value
+                    for name, value in make_record(id, sample, None).items() if not name.startswith("image.")}
+        record["image"] = blobs.index[key]
+        records.append(record)
+
+    os.makedirs(write_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(write_dir, "shard-*.tar")) + glob.glob(os.path.join(write_dir, "layout.json")):
+        os.remove(path)
+
+    index = {"blobs": os.path.relpath(blobs.blob_path, write_dir), "records": records}
+    with open(os.path.join(write_dir, "index.json.tmp"), "w") as f: json.dump(index, f)
+    os.replace(os.path.join(write_dir, "index.json.tmp"), os.path.join(write_dir, "index.json"))
+
+    elapsed = time.perf_counter() - start
+    print(f"{len(samples)} samples ({added} figures added to the blob store), {elapsed:.1f}s "
+          f"({len(samples) / max(elapsed, 1e-9):.1f} images/s)")
+
+    return [(0, samples)]
@@ -13,9 +13,78 @@ def load_json(json_path):
     """Load JSON file"""
     with open(json_path, 'r') as f: return json.load(f)
 
-def save_json(data, json_path):
-    """Save JSON file"""
-    with open(json_path, 'w') as f: json.dump(data, f, indent=4)
+def save_json(data, json_path, compact=False):
+    """Save JSON file (without indentation and spaces if compact)"""
+    with open(json_path, 'w') as f:
+        if compact: json.dump(data, f, separators=(",", ":"))
+        else: json.dump(data, f, indent=4)
+
+def iter_json_array(json_path, chunk_size=1 << 20):
+    """
+        Yield the items of a JSON file holding a top-level array
+
+        The file is read in chunks of chunk_size characters and decoded item by
+        item, so only one chunk and one item are held in memory
+    """
+    decoder = json.JSONDecoder()
+
+    with open(json_path, 'r') as f:
+        buffer, pos = f.read(chunk_size), 0
+        started = False
+
+        while True:
+            # skip whitespace and separators, reading more if the buffer is exhausted
+            while pos < len(buffer) and (buffer[pos].isspace() or (started and buffer[pos] == ",")):
+                pos += 1
+
+            if pos == len(buffer):
+                more = f.read(chunk_size)
+                if not more: raise ValueError(f"{json_path}: unexpected end of JSON array")
+                buffer, pos = more, 0
+                continue
+
+            if not started:
+                if buffer[pos] != "[": raise ValueError(f"{json_path}: not a JSON array")
+                started = True
+                pos += 1
+                continue
+
+            if buffer[pos] == "]": return
+
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                more = f.read(chunk_size)
+                if not more: raise
+                buffer, pos = buffer[pos:] + more, 0
+                continue
+
+            yield item
+            pos = end
+
+            if pos > chunk_size:
+                buffer, pos = buffer[pos:], 0
+
+def write_json_object(items, json_path):
+    """
+        Write (key, value) pairs as a compact JSON object, one item at a time
+
+        Returns:
+            Number of written items
+    """
+    count = 0
+
+    with open(json_path, 'w') as f:
+        f.write("{")
+        for key, value in items:
+            if count: f.write(",")
+            f.write(json.dumps(key))
+            f.write(":")
+            f.write(json.dumps(value, separators=(",", ":")))
+            count += 1
+        f.write("}")
+
+    return count
 
 def get_patent_id(filename):
     """Return patent id"""